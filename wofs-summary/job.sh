@@ -7,7 +7,9 @@
 module load agdc-py3-prod/1.5.2
 
 
-/usr/bin/time xargs -n1 -P32 -I{} --verbose sh -c "if [ ! -e done.{} ] && [ ! -e failed.{} ] ; then /usr/bin/time python simple.py /g/data/v10/testing_ground/wofs_summary/wofs_{}_ /g/data/v10/testing_ground/wofs_brl/output/*/{} && touch done.{} || (echo $? > failed.{}) ; fi" < subset.$PBS_ARRAY_INDEX
+# Reading bands of 800 rows (--window) rather than whole tiles bounds the memory of each process (to about 0.3GB,
+# mostly the full-size counts), so a node can run more processes than cpus, to overlap their (NetCDF) I/O.
+/usr/bin/time xargs -n1 -P64 -I{} --verbose sh -c "if [ ! -e done.{} ] && [ ! -e failed.{} ] ; then /usr/bin/time python simple.py --window 800 /g/data/v10/testing_ground/wofs_summary/wofs_{}_ /g/data/v10/testing_ground/wofs_brl/output/*/{} && touch done.{} || (echo $? > failed.{}) ; fi" < subset.$PBS_ARRAY_INDEX
 
 
 # Usage:
@@ -2,15 +2,20 @@
 
 Wet/Clear observation counts.
 
-Recommended usage: see job.sh
+Recommended usage: see job.sh (optionally with --workers, to decode the tiles on a pool of processes)
+
+Memory: with --window, bands of that many rows (rounded to the chunks of the files) are read
+from every observation in turn, rather than whole tiles, so that only the counts are kept at full size.
 
 Performance: 
- - YAML parsing is slow. Could test obtaining JSON from DB index (and forego globbing)
+ - YAML parsing is slow, so the metadata needed for grouping (and GQA filtering) is kept in a
+   columnar index (OUTPUT_PREFIX + metadata.npz), parsed only for datasets new since the last run.
  - Array operations could be optimised with numexpr (even with broadcasting for dual output),
    but requires future (e.g. v3) numexpr release to support relevant bitwise operations. 
    
-TODO: record which datasets are utilised, and facilitate incrementally augmenting previous
-outputs as new datasets become available.
+Incremental: the counts are saved (OUTPUT_PREFIX + state.npz) with the ids and dates of the
+datasets that contributed, so that a rerun only reads the datasets that have since become available.
+(If a previously counted date gains datasets, its observation must be refused, so all are recounted.)
 
 """
 
@@ -20,22 +25,25 @@ import functools
 class reader:
     """ Read one water-extents tile/dataset """
     cell = None
-    def __init__(self, file):
+    def __init__(self, file, id=None, date=None):
         self.path = file
+        self.id = id # as recorded in the metadata index
+        self.date = date
         if self.cell is None:
             self.configure_cell(file) # Assume all files will cover same spatial cell
     @classmethod
     def configure_cell(cls, example):
         import rasterio
         with rasterio.open('NetCDF:' + example + ':water') as f:
-            cls.cell = dict(affine=f.profile['affine'], crs=f.profile['crs'])
+            cls.cell = dict(affine=f.profile['affine'], crs=f.profile['crs'], width=f.width, height=f.height)
     @property
     def netcdf(self):
         import netCDF4
         return netCDF4.Dataset(self.path)
     @property
     def metadata_doc(self):
-        return self.netcdf['dataset'][0].tostring().decode('unicode_escape')
+        with self.netcdf as nc:
+            return nc['dataset'][0].tobytes().decode('unicode_escape')
     @property
     @functools.lru_cache()
     def metadata(self):
@@ -45,10 +53,16 @@ class reader:
         import yaml
         return yaml.load(self.metadata_doc, Loader=yaml.CLoader)
     @property
+    def dataset_id(self):
+        return str(self.metadata['id'])
+    @property
     def timestamp(self):
         return self.metadata['extent']['center_dt']
     @property
-    def date(self):
+    def platform(self):
+        return self.metadata['platform']['code']
+    @property
+    def local_date(self):
         import datetime
         import dateutil.parser
         return (dateutil.parser.parse(self.timestamp) + datetime.timedelta(hours=10)).date() # rough conversion to local date
@@ -66,58 +80,177 @@ class reader:
         #    ['lineage']['source_datasets']['level1'] \
         #    ['gqa']['residual']['cep90']
     @property
+    def chunk_rows(self):
+        with self.netcdf as nc:
+            chunking = nc['water'].chunking()
+        return 1 if chunking == 'contiguous' else chunking[-2]
+    def read(self, window=None):
+        """ Water of the tile, or of a window of it (as row and column slices) """
+        with self.netcdf as nc:
+            nc.set_auto_mask(False) # nodata is a flag like any other
+            return nc['water'][(0,) + (window or (slice(None), slice(None)))]
+    @property
     def water(self):
-        return np.squeeze(self.netcdf['water'])
+        return self.read()
+
+def fuse(layers):
+    """ Flags of the valid layers ORed together, or (where none are valid) those of the last """
+    if len(layers) == 1:
+        return layers[0]
+    valid = (layers & np.uint8(1)) == 0
+    fused = np.bitwise_or.reduce(np.where(valid, layers, np.uint8(0)), axis=0)
+    return np.where(valid.any(axis=0), fused, layers[-1])
 
 class fuser:
     """ Combine one or more datasets into a single-rasterisable package """
     def __init__(self, tiles):
         self.tiles = tiles
+        self._layers = self._water = None # decoded once, until released
         #print(len(tiles),end='')
     @property
+    def date(self):
+        return self.tiles[0].date
+    @property
+    def ids(self):
+        return [tile.id for tile in self.tiles]
+    @property
+    def layers(self):
+        """ Stack of the water of each tile """
+        if self._layers is None:
+            self._layers = np.stack([tile.water for tile in self.tiles])
+        return self._layers
+    @property
     def water(self):
-        output = self.tiles[0].water
-        for tile in self.tiles[1:]:
-            # TODO: could numexpr
-            subsequent = tile.water
-            empty = (output & 1).astype(np.bool)
-            both = ~empty & ~((subsequent & 1).astype(np.bool))
-            output[empty] = subsequent[empty]
-            output[both] |= subsequent[both]
-        return output
-
-def do_work(observations):
-    """ Aggregate data while reading one whole file at a time into memory """    
+        if self._water is None:
+            self._water = fuse(self.layers)
+        return self._water
+    def read(self, window=None):
+        """ Fused water, or that of a window (uncached) """
+        if window is None:
+            return self.water
+        return fuse(np.stack([tile.read(window) for tile in self.tiles]))
+    def release(self):
+        self._layers = self._water = None
+
+def decode(observation, window=None):
+    water = observation.read(window)
+    observation.release() # lest every observation stay in memory
+    return water
+
+def prefetch(reads, workers=1, depth=None):
+    """ Yield the water of each (observation, window) in order, decoded up to depth ahead on a pool of processes """
+    import itertools
+    if workers < 2:
+        yield from itertools.starmap(decode, reads)
+        return
+
+    import collections
+    import concurrent.futures
+    reads = iter(reads)
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        pending = collections.deque(pool.submit(decode, *read)
+                                    for read in itertools.islice(reads, depth or 2 * workers))
+        while pending:
+            water = pending.popleft().result()
+            pending.extend(pool.submit(decode, *read) for read in itertools.islice(reads, 1))
+            yield water
+
+def do_work(observations, workers=1, window=None):
+    """
+    Aggregate data while reading one whole file (or else a band of window rows of it) at a time into memory,
+    decoding upcoming files meanwhile
+    """
     import numpy as np
 
-    wet_accumulator = np.zeros((4000,4000),np.uint16)
-    dry_accumulator = np.zeros((4000,4000),np.uint16)
-    
+    shape = reader.cell['height'], reader.cell['width']
+    wet_accumulator = np.zeros(shape, np.uint16)
+    dry_accumulator = np.zeros(shape, np.uint16)
+
+    if window and observations:
+        chunk_rows = observations[0].tiles[0].chunk_rows # assume all files are chunked alike
+        rows = max(1, window // chunk_rows) * chunk_rows
+        bands = [(slice(y, y + rows), slice(None)) for y in range(0, shape[0], rows)]
+    else:
+        bands = [None]
+    reads = [(obs, band) for band in bands for obs in observations]
+
     land_or_sea = ~np.uint8(4) # to mask out the marine flag
     #wet_versus_dry = np.array([128,0])[None,None,:]
 
-    for f in observations:
-        bitfield = f.water & land_or_sea
+    for (_, band), water in zip(reads, prefetch(reads, workers)):
+        bitfield = water & land_or_sea
+        region = band or (slice(None), slice(None))
 
-        wet_accumulator += bitfield == 128
-        dry_accumulator += bitfield == 0
+        wet_accumulator[region] += bitfield == 128
+        dry_accumulator[region] += bitfield == 0
         #print('.', end='')
     #print('')
     return wet_accumulator, dry_accumulator
 
-def summarise_result(observations, prefix=''):
-    """ Perform counts and from those produce outputs """
-    wet, dry = do_work(observations)
+def load_state(filename):
+    """ Previous wet and clear counts, and the date of each dataset that contributed (by id) """
+    import os
+    if not os.path.exists(filename):
+        return None
+    with np.load(filename) as state:
+        return state['wet'], state['clear'], dict(zip(state['ids'], state['dates']))
+
+def save_state(filename, wet, clear, contributed):
+    """ Persist counts with the manifest of contributing datasets (atomically, in case of interruption) """
+    import os
+    ids = sorted(contributed)
+    with open(filename + '.tmp', 'wb') as f:
+        np.savez_compressed(f, wet=wet, clear=clear,
+                            ids=np.array(ids, dtype=str),
+                            dates=np.array([contributed[i] for i in ids], dtype=str))
+    os.replace(filename + '.tmp', filename)
+
+def new_observations(observations, contributed):
+    """ Observations not yet counted (or None if a counted date has gained datasets) """
+    counted_dates = set(contributed.values())
+    new = []
+    for obs in observations:
+        if str(obs.date) not in counted_dates:
+            new.append(obs)
+        elif any(i not in contributed for i in obs.ids):
+            return None
+    return new
+
+def summarise_result(observations, prefix='', workers=1, window=None):
+    """ Perform counts (adding to those of a previous run) and from those produce outputs """
+    state_file = prefix + 'state.npz'
+    state = load_state(state_file)
+    contributed = {}
+    if state is not None:
+        new = new_observations(observations, state[2])
+        if new is None:
+            print('Previously counted dates have new datasets; recounting all')
+            state = None
+        else:
+            print('{} of {} observations not previously counted'.format(len(new), len(observations)))
+            if not new:
+                return
+            observations = new
+            contributed = state[2]
+
+    wet, dry = do_work(observations, workers, window)
 
     clear_observation_count = wet + dry
+    if state is not None:
+        wet += state[0]
+        clear_observation_count += state[1]
 
     import numpy as np
     with np.errstate(invalid='ignore'): # denominator may be zero
-        frequency = wet / clear_observation_count
+        frequency = np.true_divide(wet, clear_observation_count, dtype=np.float32)
 
     write(prefix + 'clear.tif', clear_observation_count)
     write(prefix + 'wet.tif', wet)
-    write(prefix + 'frequency.tif', frequency.astype(np.float32), nodata=np.nan)
+    write(prefix + 'frequency.tif', frequency, nodata=np.nan)
+
+    for obs in observations:
+        contributed.update((i, str(obs.date)) for i in obs.ids)
+    save_state(state_file, wet, clear_observation_count, contributed)
 
     """
     import matplotlib.pyplot as plt
@@ -130,19 +263,47 @@ def get_filenames(*directories):
     from glob import glob
     return [x for d in directories for x in glob(d + '/*.nc')]
 
-def get_observations(files):
-    """ Group datasets into observations, and perform GQA filtering """
+INDEX_COLUMNS = ['path', 'mtime', 'id', 'timestamp', 'date', 'gqa', 'platform']
+
+def update_index(filename, files):
+    """ Metadata of the files (as columns), from the index file, parsing only files new or modified since """
+    import os
     import pandas
 
-    rr = map(reader, files)
-    
-    p = [(r, r.date) for r in rr if r.gqa<1] # GQA filter threshold
-    tiles = pandas.DataFrame(p, columns=['object', 'date'])
-    g = tiles.groupby('date', sort=False)
+    mtimes = pandas.Series({path: os.path.getmtime(path) for path in files}, dtype=np.float64)
+    index = pandas.DataFrame(columns=INDEX_COLUMNS)
+    if os.path.exists(filename):
+        with np.load(filename) as f:
+            index = pandas.DataFrame({column: f[column] for column in INDEX_COLUMNS})
+    current = index.path.map(mtimes).eq(index.mtime) # i.e. neither removed nor rewritten
+    new = mtimes.index.difference(index.path[current])
+
+    if len(new) or not current.all() or not os.path.exists(filename):
+        rr = [reader(path) for path in new]
+        index = pandas.concat([index[current], pandas.DataFrame(
+            dict(path=new, mtime=mtimes[new].values, id=[r.dataset_id for r in rr],
+                 timestamp=[r.timestamp for r in rr], date=[str(r.local_date) for r in rr],
+                 gqa=[r.gqa for r in rr], platform=[r.platform for r in rr]))], ignore_index=True)
+        types = dict(mtime=np.float64, gqa=np.float32)
+        with open(filename + '.tmp', 'wb') as f:
+            np.savez_compressed(f, **{column: np.asarray(index[column], dtype=types.get(column, str))
+                                      for column in INDEX_COLUMNS})
+        os.replace(filename + '.tmp', filename)
+        print('Indexed metadata of {} new files'.format(len(new)))
+    return index
+
+def get_observations(files, index_file='metadata.npz'):
+    """ Group datasets into observations, and perform GQA filtering """
+    index = update_index(index_file, files)
+    if files and reader.cell is None:
+        reader.configure_cell(files[0]) # even if no tile passes the filter (so the counts are all zero)
+
+    p = index[index.gqa < 1] # GQA filter threshold
+    g = p.groupby('date', sort=False)
 
     print('{} observations; {} of {} tiles'.format(len(g), len(p), len(files)))
 
-    return [fuser(list(obs.object)) for date, obs in g]
+    return [fuser([reader(path, id=i, date=date) for path, i in zip(obs.path, obs.id)]) for date, obs in g]
 
 
 
@@ -150,7 +311,7 @@ def show_obs(fus):
     """ Plotting (for debugging only) """
     import matplotlib.pyplot as plt
     fig, axes = plt.subplots(1,1+len(fus.tiles))
-    for ax, w in zip(axes, [t.water for t in fus.tiles]+[fus.water]):
+    for ax, w in zip(axes, list(fus.layers)+[fus.water]):
         ax.imshow((w & np.uint8(1))[::10,::10])
 
 def write(filename, data, nodata=None):
@@ -158,8 +319,6 @@ def write(filename, data, nodata=None):
     import rasterio
     with rasterio.open(filename,
                        mode='w',
-                       width=4000,  # should absorb into reader.cell
-                       height=4000, #
                        count=1,
                        dtype=data.dtype.name,
                        driver='GTIFF',
@@ -171,16 +330,20 @@ def write(filename, data, nodata=None):
 
 def main():
     """ Command-line Interface """
-    import sys
-    if len(sys.argv) < 3:
-        print("Usage: python simple.py  OUTPUT_PREFIX  INPUT_TILE_DIRS..") # TODO: deprecate >1 input dirs
-        sys.exit(2)
-
-    output_prefix = sys.argv[1]
-    input_dirs = sys.argv[2:]
+    import argparse
+    parser = argparse.ArgumentParser(description='Wet/Clear observation counts')
+    parser.add_argument('output_prefix', metavar='OUTPUT_PREFIX')
+    parser.add_argument('input_dirs', metavar='INPUT_TILE_DIRS', nargs='+') # TODO: deprecate >1 input dirs
+    parser.add_argument('--workers', type=int, default=1, help='processes decoding tiles (default: %(default)s)')
+    parser.add_argument('--window', type=int, metavar='ROWS',
+                        help='read bands of this many rows at a time (rounded to chunks), rather than whole tiles')
+    args = parser.parse_args()
 
-    obs = get_observations(get_filenames(*input_dirs))
-    summarise_result(obs, prefix=output_prefix)
+    files = get_filenames(*args.input_dirs)
+    if not files:
+        parser.exit(1, 'No tiles (*.nc) found in {}\n'.format(', '.join(args.input_dirs)))
+    obs = get_observations(files, index_file=args.output_prefix + 'metadata.npz')
+    summarise_result(obs, prefix=args.output_prefix, workers=args.workers, window=args.window)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,276 @@
+"""
+Offline benchmarks of the wofl algorithm, on synthetic inputs.
+
+Generates NBAR, PQ and DSM Datasets (at production tile size by default, with the DSM
+buffered as for the terrain shadows) and times the stages of the algorithm across a grid
+of tile sizes, NBAR dtypes and terrain roughness. Needs neither a database nor network
+(only the usual libraries, e.g. GDAL for the solar geometry).
+
+The output files (WOfLs) are also benchmarked, for each codec and dtype: the time to write
+them, to read them back whole (as the summary does), and their size on disk.
+
+Each case reports the best of several timings, and the peak memory traced (by tracemalloc,
+which includes numpy arrays) in a separate run. Results are written as JSON, so that runs
+from different commits can be compared:
+
+    python -m wofs.benchmark --output before.json
+    python -m wofs.benchmark --output after.json --compare before.json
+"""
+from __future__ import absolute_import, division, print_function
+
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+import tracemalloc
+from itertools import product
+
+import click
+import numpy
+import scipy
+import xarray
+from scipy import ndimage
+
+import datacube  # pylint: disable=unused-import; registers the geographic (e.g. affine) xarray extensions
+from datacube.utils.geometry import CRS
+import wofs
+from wofs import classifier, filters, terrain, wofls
+from wofs.output import netcdf_variable_params
+
+RESOLUTION = 25.0  # metres
+DSM_BUFFER = int(numpy.ceil(wofls.SHADOW_HALO_METRES / RESOLUTION))  # pixels
+ORIGIN = (1500000.0, -3900000.0)  # (x, y), Australian Albers
+TIME = numpy.datetime64('2010-06-15T00:30:00')  # winter morning, for long shadows
+NODATA = -999
+
+
+def _coords(size, buffer=0):
+    x = ORIGIN[0] + RESOLUTION * (numpy.arange(-buffer, size + buffer) + 0.5)
+    y = ORIGIN[1] - RESOLUTION * (numpy.arange(-buffer, size + buffer) + 0.5)
+    return dict(y=y, x=x)
+
+
+def synthetic_nbar(size, dtype='int16', seed=0):
+    """Six surface reflectance bands, with patches of water (dark in the infrared) and of nodata"""
+    rng = numpy.random.RandomState(seed)
+    wet = ndimage.uniform_filter(rng.random_sample((size, size)), 15) > 0.52
+    nodata = numpy.zeros((size, size), dtype=bool)
+    nodata[:, :size // 10] = True  # e.g. the edge of a scene
+
+    bands = {}
+    for name, (dry, water) in zip(classifier.BANDS, [(600, 400), (900, 500), (1100, 350),
+                                                     (2500, 150), (2800, 80), (1900, 50)]):
+        band = numpy.where(wet, water, dry) * (0.6 + 0.8 * rng.random_sample((size, size)))
+        band = numpy.where(nodata, NODATA, band).astype(dtype)
+        bands[name] = xarray.DataArray(band, coords=_coords(size), dims=('y', 'x'), attrs=dict(nodata=NODATA))
+    return xarray.Dataset(bands, coords=dict(time=TIME))
+
+
+def synthetic_pq(size, seed=0):
+    """Pixel quality, clear except for clouds (and their shadows) covering a fraction of the tile"""
+    rng = numpy.random.RandomState(seed)
+    clear = numpy.int16(0x3FFF)
+    cloud = ndimage.uniform_filter(rng.random_sample((size, size)), 25) > 0.53
+    shadow = numpy.roll(cloud, (size // 50, size // 50), axis=(0, 1)) & ~cloud
+    pqa = numpy.where(cloud, clear & ~filters.PQA_CLOUD_BITS, clear)
+    pqa = numpy.where(shadow, clear & ~filters.PQA_CLOUD_SHADOW_BITS, pqa).astype(numpy.int16)
+    return xarray.Dataset(dict(pqa=(('y', 'x'), pqa)), coords=_coords(size))
+
+
+def synthetic_dsm(size, roughness, seed=0):
+    """Elevation (buffered for terrain shadows), as smoothed noise with a relief of roughly roughness metres"""
+    rng = numpy.random.RandomState(seed)
+    shape = (size + 2 * DSM_BUFFER,) * 2
+    relief = ndimage.gaussian_filter(rng.standard_normal(shape), 12)
+    relief *= roughness / max(relief.max() - relief.min(), 1e-9)
+    elevation = (50 + relief - relief.min()).astype(numpy.float32)
+    return xarray.Dataset(dict(elevation=(('y', 'x'), elevation)), coords=_coords(size, DSM_BUFFER),
+                          attrs=dict(crs=CRS('EPSG:3577')))
+
+
+def synthetic_wofl(size, seed=0):
+    """Water observation flags (of one acquisition), as classified and masked for nodata and clouds"""
+    nbar = synthetic_nbar(size, seed=seed)
+    water = classifier.classify(nbar) | filters.eo_filter(nbar) | filters.pq_filter(synthetic_pq(size, seed).pqa)
+    return numpy.asarray(water, dtype=numpy.uint8)[numpy.newaxis]
+
+
+def write_wofl(path, water, params):
+    """Write flags (time, y, x) as the datacube would, with netCDF4 variable options"""
+    import netCDF4
+    params = dict(params)
+    if 'chunksizes' in params:
+        params['chunksizes'] = [min(chunk, length) for chunk, length in zip(params['chunksizes'], water.shape)]
+    with netCDF4.Dataset(path, 'w') as nco:
+        for dim, length in zip(('time', 'y', 'x'), water.shape):
+            nco.createDimension(dim, length)
+        nco.createVariable('water', water.dtype, ('time', 'y', 'x'), fill_value=1, **params)[:] = water
+
+
+def read_wofl(path):
+    import netCDF4
+    with netCDF4.Dataset(path) as nco:
+        nco.set_auto_mask(False)
+        return nco['water'][:]
+
+
+def _measure(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return dict(times=times, best=min(times), peak_traced_mb=peak / 2 ** 20)
+
+
+def _cases(size, dtype, roughness, shadow_method):
+    """The benchmarked functions (and the parameters that matter to each), on the given inputs"""
+    nbar = synthetic_nbar(size, dtype)
+    pq = synthetic_pq(size)
+    dsm = synthetic_dsm(size, roughness)
+
+    return [
+        ('classify', dict(dtype=dtype), lambda: classifier.classify(nbar)),
+        ('eo_filter', dict(dtype=dtype), lambda: filters.eo_filter(nbar)),
+        ('pq_filter', dict(), lambda: filters.pq_filter(pq.pqa)),
+        ('shadows_and_slope', dict(roughness=roughness, shadow_method=shadow_method),
+         lambda: terrain.shadows_and_slope(dsm, TIME, shadow_method=shadow_method)),
+        ('terrain_filter', dict(roughness=roughness, shadow_method=shadow_method),
+         lambda: filters.terrain_filter(dsm, nbar, shadow_method=shadow_method)),
+        ('woffles', dict(dtype=dtype, roughness=roughness, shadow_method=shadow_method),
+         lambda: wofls.woffles(nbar, pq, dsm, shadow_method=shadow_method)),
+    ]
+
+
+def run(sizes, dtypes, roughnesses, shadow_methods, benchmarks=None, repeat=3):
+    """
+    Benchmark each function over the grid of parameters (skipping repeats of cases that don't depend on them).
+
+    :return: list of result records
+    """
+    results = []
+    seen = set()
+    for size, dtype, roughness, shadow_method in product(sizes, dtypes, roughnesses, shadow_methods):
+        for name, params, func in _cases(size, dtype, roughness, shadow_method):
+            params = dict(params, size=size)
+            key = (name, tuple(sorted(params.items())))
+            if (benchmarks and name not in benchmarks) or key in seen:
+                continue
+            seen.add(key)
+            record = dict(benchmark=name, params=params, **_measure(func, repeat))
+            click.echo('%-18s %-60s %8.3fs %8.0fMB' % (name, json.dumps(params, sort_keys=True),
+                                                      record['best'], record['peak_traced_mb']), err=True)
+            results.append(record)
+    return results
+
+
+def _codec(spec):
+    """codec[:level], e.g. zlib:4 or none"""
+    codec, _, level = spec.partition(':')
+    return codec, int(level) if level else None
+
+
+def run_io(sizes, codecs, dtypes, benchmarks=None, repeat=3):
+    """
+    Benchmark writing and reading WOfLs with each codec (as codec[:level]) and dtype.
+
+    :return: list of result records (including the bytes on disk)
+    """
+    results = []
+    if benchmarks and not {'write_wofl', 'read_wofl'} & set(benchmarks):
+        return results
+    directory = tempfile.mkdtemp(prefix='wofs-benchmark-')
+    try:
+        for size, spec, dtype in product(sizes, codecs, dtypes):
+            codec, level = _codec(spec)
+            water = synthetic_wofl(size).astype(dtype)
+            params = netcdf_variable_params(dict(compression=codec, fletcher32=True, chunksizes=[1, 200, 200],
+                                                 **(dict(complevel=level) if level else {})))
+            path = os.path.join(directory, '%s_%s_%d.nc' % (spec.replace(':', ''), dtype, size))
+            write_wofl(path, water, params)
+            assert (read_wofl(path) == water).all()
+
+            for name, func in [('write_wofl', lambda: write_wofl(path, water, params)),
+                               ('read_wofl', lambda: read_wofl(path))]:
+                if benchmarks and name not in benchmarks:
+                    continue
+                record = dict(benchmark=name, params=dict(size=size, codec=spec, dtype=dtype),
+                              bytes=os.path.getsize(path), **_measure(func, repeat))
+                click.echo('%-18s %-60s %8.3fs %8.0fMB %10dB' % (name, json.dumps(record['params'], sort_keys=True),
+                                                                 record['best'], record['peak_traced_mb'],
+                                                                 record['bytes']), err=True)
+                results.append(record)
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+
+def environment():
+    return dict(wofs=wofs.__version__, python=platform.python_version(), machine=platform.machine(),
+                processor=platform.processor(), numpy=numpy.__version__, scipy=scipy.__version__,
+                xarray=xarray.__version__)
+
+
+def compare(baseline, results):
+    """Ratios of the best times of matching cases (above one meaning slower than the baseline)"""
+    def key(record):
+        return record['benchmark'], json.dumps(record['params'], sort_keys=True)
+
+    previous = {key(record): record for record in baseline}
+    return [dict(benchmark=record['benchmark'], params=record['params'],
+                 ratio=record['best'] / previous[key(record)]['best'])
+            for record in results if key(record) in previous]
+
+
+def _split(value):
+    return [item for item in value.split(',') if item]
+
+
+@click.command()
+@click.option('--sizes', default='4000', help='Comma separated tile sizes (pixels)')
+@click.option('--dtypes', default='int16,float32', help='Comma separated NBAR dtypes')
+@click.option('--roughness', default='0,200,1000', help='Comma separated terrain relief (metres)')
+@click.option('--shadow-methods', default=','.join(terrain.SHADOW_METHODS), help='Comma separated shadow methods')
+@click.option('--codecs', default='none,zlib:1,zlib:4,zlib:9',
+              help='Comma separated output codecs, as codec[:level] (e.g. zstd:3, given netCDF4 support)')
+@click.option('--output-dtypes', default='uint8,int16', help='Comma separated output dtypes')
+@click.option('--benchmarks', default='', help='Comma separated subset of benchmarks to run')
+@click.option('--repeat', type=click.IntRange(1), default=3, help='Timings per case (the best is reported)')
+@click.option('--output', type=click.Path(dir_okay=False), help='JSON file for the results (default: stdout)')
+@click.option('--compare', 'baseline', type=click.File(), help='Results of a previous run to compare against')
+def main(sizes, dtypes, roughness, shadow_methods, codecs, output_dtypes, benchmarks, repeat, output, baseline):
+    sizes = [int(size) for size in _split(sizes)]
+    results = run(sizes=sizes,
+                  dtypes=_split(dtypes),
+                  roughnesses=[float(value) for value in _split(roughness)],
+                  shadow_methods=_split(shadow_methods),
+                  benchmarks=_split(benchmarks),
+                  repeat=repeat)
+    results += run_io(sizes=sizes, codecs=_split(codecs), dtypes=_split(output_dtypes), benchmarks=_split(benchmarks),
+                      repeat=repeat)
+    document = dict(environment=environment(), results=results)
+    if baseline:
+        document['comparison'] = compare(json.load(baseline)['results'], results)
+        for record in document['comparison']:
+            click.echo('%-18s %-60s %6.2fx' % (record['benchmark'], json.dumps(record['params'], sort_keys=True),
+                                               record['ratio']), err=True)
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(document, f, indent=2)
+    else:
+        click.echo(json.dumps(document, indent=2))
+
+
+if __name__ == '__main__':
+    main()  # pylint: disable=no-value-for-parameter
@@ -0,0 +1,46 @@
+"""
+Bounded in-memory caching, for reuse of intermediate products between tasks on the same worker.
+"""
+from __future__ import absolute_import
+
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Least-recently-used cache, counting hits and misses.
+
+    The value for a missing key is computed (outside of the lock) by the supplied callable.
+    A maxsize of zero disables caching.
+    """
+    def __init__(self, maxsize=1):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, compute):
+        with self._lock:
+            if key in self._items:
+                self.hits += 1
+                value = self._items.pop(key)
+                self._items[key] = value  # most recently used
+                return value
+            self.misses += 1
+
+        value = compute()
+
+        with self._lock:
+            self._items[key] = value
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, size=len(self._items), maxsize=self.maxsize)
@@ -3,13 +3,16 @@
 import numpy
 import logging
 import gc
-from wofs import boilerplate
+import xarray
+from fractions import Fraction
 
 # import argparse
 # from osgeo import gdal
 
-@boilerplate.simple_numpify
-def classify(images, float64=False):
+BANDS = ['blue', 'green', 'red', 'nir', 'swir1', 'swir2']  # Landsat 5 & 7 bands 1, 2, 3, 4, 5, 7
+
+
+def classify(images, float64=False, backend='fused'):
     """
     Produce a water classification image from the supplied images (6 bands of an NBAR, multiband Landsat image)
     This method evaluates N.Mueller's decision tree as follows:
@@ -38,19 +41,31 @@ def classify(images, float64=False):
                   N19     N20                          N31     N32  N33     N34         N44     N45
 
     :param images:
-        A 3D numpy array ordered in (bands,rows,columns), containing the spectral data.
+        A 3D array (numpy or xarray) ordered in (bands,rows,columns), containing the spectral data.
         It is assumed that the spectral bands follow Landsat 5 & 7, Band 1, Band 2, Band 3, Band 4, Band 5, Band 7.
+        Alternatively a Dataset (or other mapping) of the individual BANDS, which avoids concatenating them.
+        A stack is also accepted, ordered in (bands,time,rows,columns) or with (time,rows,columns) bands
+        (which the masks backend classifies one acquisition at a time).
 
     :param float64:
         Boolean keyword. If set to True then the data will be converted to type float64 if not already float64.
         Default is False.
 
+    :param backend:
+        Either 'fused' (default), 'integer' or 'masks'. The fused engine walks each cache-sized block of pixels
+        down the tree once, whereas the masks engine evaluates every node as a full-tile boolean mask.
+        The integer engine walks the blocks like the fused engine, but tests the normalised ratios as
+        exact integer inequalities on the (up to 16-bit integer) bands, reproducing the float32 results.
+        All produce identical output.
+
     :return:
-        A 2D numpy array of type UInt8.  Values will be 0 for No Water, 1 for Unclassified and 128 for water.
+        A 2D array of type UInt8 (a DataArray, if the input is xarray).
+        Values will be 0 for No Water, 1 for Unclassified and 128 for water.
 
     :notes:
         The input array will be converted to type float32 if not already float32.
         If images is of type float64, then images datatype will be left as is.
+        (The fused backend only converts the pixels needed for each node, not the whole input.)
 
     :transcription:
         Transcribed from a Tree diagram output by CART www.salford-systems.com
@@ -58,6 +73,41 @@ def classify(images, float64=False):
 
     """
 
+    def unwrap(array):
+        return array.data if isinstance(array, xarray.DataArray) else array
+
+    if isinstance(images, (numpy.ndarray, xarray.DataArray)):
+        like = images[0]
+        bands = unwrap(images)
+    else:
+        like = images[BANDS[0]]
+        bands = [unwrap(images[name]) for name in BANDS]
+
+    if backend == 'fused':
+        classified = _classify_fused(bands, float64)
+    elif backend == 'integer':
+        if float64:
+            raise ValueError('The integer classifier reproduces float32 arithmetic only')
+        classified = _classify_fused(bands, test=_integer_test)
+    elif backend == 'masks':
+        bands = numpy.asarray(bands)
+        if bands.ndim == 4:
+            classified = numpy.stack([_classify_masks(bands[:, i], float64) for i in range(bands.shape[1])])
+        else:
+            classified = _classify_masks(bands, float64)
+    else:
+        raise ValueError('Unknown classifier backend: %s' % backend)
+
+    if isinstance(like, xarray.DataArray):
+        return xarray.DataArray(classified, coords=[like[dim] for dim in like.dims], dims=like.dims)
+    return classified
+
+
+def _classify_masks(images, float64=False):
+    """
+    Reference implementation of the decision tree, using full-tile boolean masks for each node.
+    """
+
     logger = logging.getLogger("WaterClasserfier")  # !? typo..
     logger.debug("Started")
 
@@ -217,3 +267,158 @@ def classify(images, float64=False):
     logger.debug("completed")
 
     return classified
+
+
+# The same tree as nested (feature, threshold, subtree if <= threshold, subtree if > threshold)
+# tuples, with the leaves holding the output class. Any comparison against NaN is false.
+_TREE = ('ndi_52', -0.01,
+         ('b1', 2083.5,
+          ('b7', 323.5,
+           ('ndi_43', 0.61, 128, 0),  # Nodes 6, 7
+           ('b1', 1400.5,
+            ('ndi_72', -0.23,
+             ('ndi_43', 0.22,
+              128,  # Node 17
+              ('b1', 473, 128, 0)),  # Nodes 19, 20
+             ('b1', 379, 128, 0)),  # Nodes 14, 15
+            ('ndi_43', -0.01, 128, 0))),  # Nodes 10, 11
+          0),  # Node 3
+         ('ndi_52', 0.23,
+          ('b1', 334.5,
+           ('ndi_43', 0.54,
+            ('ndi_52', 0.12,
+             128,  # Node 27
+             ('b3', 364.5,
+              ('b1', 129.5, 128, 0),  # Nodes 31, 32
+              ('b1', 300.5, 128, 0))),  # Nodes 33, 34
+            0),  # Node 25
+           0),  # Node 23
+          ('ndi_52', 0.34,
+           ('b1', 249.5,
+            ('ndi_43', 0.45,
+             ('b3', 364.5,
+              ('b1', 129.5, 128, 0),  # Nodes 44, 45
+              0),  # Node 42
+             0),  # Node 40
+            0),  # Node 38
+           0)))  # Node 36
+
+# Band indices of each feature (a second index denotes the normalised ratio of the pair)
+_FEATURES = {'b1': (0,), 'b3': (2,), 'b7': (5,),
+             'ndi_52': (4, 1), 'ndi_43': (3, 2), 'ndi_72': (5, 1)}
+
+BLOCK_SIZE = 2 ** 16  # pixels per block, such that the six bands of a block stay in cache
+
+
+def _working_dtype(dtype, float64):
+    """The floating point type in which the tree is evaluated (see notes on classify)."""
+    if float64 or dtype == 'float64':
+        return numpy.dtype('float64')
+    return numpy.dtype('float32')
+
+
+def _feature(name, bands, index, dtype):
+    """Evaluate a feature of the tree, for the selected pixels only."""
+    selected = [bands[i][index].astype(dtype, copy=False) for i in _FEATURES[name]]
+    if len(selected) == 1:
+        return selected[0]
+    a, b = selected
+    return (a - b) / (a + b)
+
+
+def _float_test(dtype):
+    """Node test that evaluates the features in floating point."""
+    def test(name, threshold, bands, index):
+        return _feature(name, bands, index, dtype) <= threshold
+    return test
+
+
+def _ratio_bound(threshold):
+    """
+    Exact integer form of the float32 test (a - b) / (a + b) <= threshold.
+
+    In float32 the difference and sum of 16-bit integers are exact and the quotient is correctly
+    rounded, so the test passes when the true quotient lies below the midpoint between the threshold
+    and the next float32, or on that midpoint if it rounds down to the threshold (ties to even).
+    Returns the midpoint as a (numerator, power of two denominator) pair, and whether the tie passes.
+    """
+    lower = numpy.float32(threshold)
+    upper = numpy.nextafter(lower, numpy.float32(numpy.inf))
+    midpoint = (Fraction(float(lower)) + Fraction(float(upper))) / 2
+    tie_passes = not lower.view(numpy.uint32) & 1
+    assert max(abs(midpoint.numerator), midpoint.denominator) < 2 ** 45, "products must fit in int64"
+    return midpoint.numerator, midpoint.denominator, tie_passes
+
+
+def _integer_test(name, threshold, bands, index):
+    """Node test equivalent to the float32 evaluation, using integer arithmetic only."""
+    selected = [bands[i][index] for i in _FEATURES[name]]
+    if selected[0].dtype.kind not in 'iu' or selected[0].dtype.itemsize > 2:
+        raise ValueError('The integer classifier requires 8 or 16 bit integer bands')
+
+    if len(selected) == 1:
+        return selected[0] <= int(numpy.floor(numpy.float32(threshold)))
+
+    a, b = [band.astype(numpy.int32) for band in selected]
+    numerator, denominator, tie_passes = _ratio_bound(threshold)
+    total = a + b
+    excess = numpy.subtract(a, b, dtype=numpy.int64)
+    excess *= denominator
+    excess -= total * numpy.int64(numerator)  # i.e. (a + b) * (quotient - midpoint) * denominator
+    # the inequality flips where a + b < 0, whereas a + b == 0 gives a float quotient of
+    # +-inf or NaN, which passes only for a - b < 0 (-inf), as does excess < 0
+    if tie_passes:
+        passed = numpy.where(total < 0, excess >= 0, excess <= 0)
+        passed &= (a != 0) | (b != 0)  # NaN
+        return passed
+    return numpy.where(total < 0, excess > 0, excess < 0)
+
+
+def _walk(tree, bands, index, test, out):
+    """
+    Send each of the indexed pixels down the tree, once, writing the leaf class into out.
+    """
+    pending = [(tree, index)]
+    while pending:
+        node, index = pending.pop()
+        if not index.size:
+            continue
+        if not isinstance(node, tuple):
+            out[index] = node
+            continue
+        name, threshold, below, above = node
+        passed = test(name, threshold, bands, index)
+        pending.append((below, index[passed]))
+        pending.append((above, index[~passed]))
+
+
+def _classify_fused(images, float64=False, block_size=BLOCK_SIZE, test=None):
+    """
+    Single pass implementation of the decision tree.
+
+    Processes the image in blocks of whole rows. Features are only computed for the pixels
+    that reach the corresponding node, so working memory is bounded by the block size
+    rather than by the tile size.
+
+    Each band may also have leading dimensions (e.g. a (time, y, x) stack), which are
+    treated as further rows.
+
+    The node test defaults to floating point evaluation (see notes on classify).
+    """
+    shape = images[0].shape
+    cols = shape[-1]
+    images = [band.reshape(-1, cols) for band in images]
+    rows = images[0].shape[0]
+    if test is None:
+        test = _float_test(_working_dtype(images[0].dtype, float64))
+
+    classified = numpy.ones((rows, cols), dtype='uint8')
+
+    step = max(1, block_size // cols)
+    index = numpy.arange(step * cols)
+    for start in range(0, rows, step):
+        stop = min(start + step, rows)
+        bands = [band[start:stop].reshape(-1) for band in images]
+        _walk(_TREE, bands, index[:bands[0].size], test, classified[start:stop].reshape(-1))
+
+    return classified.reshape(shape)
@@ -0,0 +1,40 @@
+"""
+Extents of the source datasets of tiles, e.g. to find the region of an output tile with valid data.
+"""
+from __future__ import absolute_import
+
+import operator
+
+from datacube.utils.geometry import unary_union
+
+from wofs.cache import LRUCache
+
+# Per-process cache of the (reprojected) extents of source datasets, and their union for each tile,
+# since the same datasets recur between tasks (e.g. the DSM of a cell, for every acquisition)
+EXTENT_CACHE = LRUCache(maxsize=100000)
+
+
+def tile_extent(tile, crs):
+    """Union of the extents of the source datasets of a tile, in the given CRS"""
+    datasets = tile.sources.item()
+
+    def reproject(dataset):
+        return EXTENT_CACHE.get((str(dataset.id), str(crs)), lambda: dataset.extent.to_crs(crs))
+
+    key = (tuple(sorted(str(dataset.id) for dataset in datasets)), str(crs))
+    return EXTENT_CACHE.get(key, lambda: unary_union([reproject(dataset) for dataset in datasets]))
+
+
+def separated_bounds(bounds):
+    """
+    A pair of the bounding boxes that are disjoint (so the boxes cannot all overlap), or else None.
+
+    Boxes that only touch are not separated. Along each axis, it suffices to compare the box
+    that starts last with the one that ends first.
+    """
+    for lower, upper in [('left', 'right'), ('bottom', 'top')]:
+        first = max(bounds, key=operator.attrgetter(lower))
+        second = min(bounds, key=operator.attrgetter(upper))
+        if getattr(first, lower) > getattr(second, upper):
+            return first, second
+    return None
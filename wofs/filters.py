@@ -3,16 +3,49 @@ Set individual bitflags needed for wofls.
 """
 
 import numpy as np
-import scipy.ndimage
 from wofs import terrain, constants, boilerplate
 import xarray
 
+DILATION_RADIUS = 3  # pixels
+
 def dilate(array):
     """Dilation e.g. for cloud and cloud/terrain shadow"""
-    #kernel = [[1] * 7] * 7 # blocky 3-pixel dilation
-    y,x = np.ogrid[-3:4,-3:4]
-    kernel = x*x + y*y <= 3.5**2 # disk-like 3-pixel radial dilation
-    return scipy.ndimage.binary_dilation(array, structure=kernel)
+    return dilate_bits(np.asarray(array) != 0)
+
+
+def dilate_bits(flags):
+    """
+    Dilate every bit-plane of an integer (or boolean) array at once.
+
+    Equivalent, plane by plane, to binary dilation by the disk-like kernel
+    x*x + y*y <= (DILATION_RADIUS+0.5)**2 with zero padding beyond the edges.
+    For the 3-pixel radius that disk is the union of 7x3, 5x5 and 3x7 rectangles,
+    which is built from nested single-pixel shifts combined with bitwise-or.
+    Operates on the last two (y,x) axes.
+    """
+    assert DILATION_RADIUS == 3, "rectangle decomposition assumes the 3-pixel disk"
+
+    def spread(array, axis):
+        # or each pixel with its immediate neighbours along the axis
+        result = array.copy()
+        head = [slice(None)] * array.ndim
+        tail = [slice(None)] * array.ndim
+        head[axis] = slice(1, None)
+        tail[axis] = slice(None, -1)
+        result[tuple(head)] |= array[tuple(tail)]
+        result[tuple(tail)] |= array[tuple(head)]
+        return result
+
+    wide1 = spread(flags, -1)  # half-width 1
+    wide2 = spread(wide1, -1)  # half-width 2
+    wide3 = spread(wide2, -1)  # half-width 3
+
+    # accumulate so that half-width 1 ends up spread by 3 rows, 2 by 2, and 3 by 1
+    grown = spread(wide1, -2)
+    grown |= wide2
+    grown = spread(grown, -2)
+    grown |= wide3
+    return spread(grown, -2)
 
 
 PQA_SATURATION_BITS = sum(2 ** n for n in [0, 1, 2, 3, 4, 7])  # exclude thermal
@@ -21,6 +54,21 @@ PQA_CLOUD_BITS = 0x0C00
 PQA_CLOUD_SHADOW_BITS = 0x3000
 PQA_SEA_WATER_BIT = 0x0200
 
+def _pq_flags():
+    """Tabulate the wofl flags implied by every possible 16-bit PQ word (before dilation)"""
+    ipq = ~np.arange(2 ** 16, dtype=np.uint32)  # bitwise-not, e.g. flag cloudiness rather than cloudfree
+
+    def flag(bits, value):
+        return np.uint8(value) * ((ipq & bits) != 0)
+
+    return (flag(PQA_SATURATION_BITS | PQA_CONTIGUITY_BITS, constants.MASKED_NO_CONTIGUITY) |
+            flag(PQA_SEA_WATER_BIT, constants.MASKED_SEA_WATER) |
+            flag(PQA_CLOUD_BITS, constants.MASKED_CLOUD) |
+            flag(PQA_CLOUD_SHADOW_BITS, constants.MASKED_CLOUD_SHADOW))
+
+PQ_FLAGS = _pq_flags()
+PQ_DILATED_FLAGS = np.uint8(constants.MASKED_CLOUD | constants.MASKED_CLOUD_SHADOW)
+
 @boilerplate.simple_numpify
 def pq_filter(pq):
     """
@@ -40,28 +88,28 @@ def pq_filter(pq):
     Notes:
         - will output same flag to indicate noncontiguity, oversaturation and undersaturation.
         - disregarding PQ contiguity flag (see eo_filter instead) to exclude thermal bands.
-        - permitting simultaneous flags (through addition syntax) since constants happen to be
+        - permitting simultaneous flags (through bitwise-or) since constants happen to be
           different powers of the same base.
         - dilates the cloud and cloud shadow. (Previous implementation eroded the negation.)
-        - input must be numpy not xarray.DataArray (due to depreciated boolean fancy indexing behaviour)
+        - each 16-bit word is decoded by a single lookup into PQ_FLAGS; only the cloud and
+          cloud shadow bit-planes then need a (joint) dilation pass.
     """
-    ipq = ~pq # bitwise-not, e.g. flag cloudiness rather than cloudfree
-    
-    masking = np.zeros(ipq.shape, dtype=np.uint8)
-    masking[(ipq & (PQA_SATURATION_BITS | PQA_CONTIGUITY_BITS)).astype(np.bool)] = constants.MASKED_NO_CONTIGUITY
-    masking[(ipq & PQA_SEA_WATER_BIT).astype(np.bool)] += constants.MASKED_SEA_WATER
-    masking[dilate(ipq & PQA_CLOUD_BITS)] += constants.MASKED_CLOUD
-    masking[dilate(ipq & PQA_CLOUD_SHADOW_BITS)] += constants.MASKED_CLOUD_SHADOW
+    masking = PQ_FLAGS[np.asarray(pq).astype(np.uint16, copy=False)]
+
+    cloudy = masking & PQ_DILATED_FLAGS
+    masking &= ~PQ_DILATED_FLAGS
+    masking |= dilate_bits(cloudy) # cloud and cloud shadow dilated together, one bit-plane each
     return masking
 
-def terrain_filter(dsm, nbar):
+def terrain_filter(dsm, nbar, shadow_method='rotate', solar_vec=None):
     """
     Terrain shadow masking, slope masking, solar incidence angle masking.
 
-    Input: xarray DataSets
+    Input: xarray DataSets (and optionally the solar vector, see terrain.shadows_and_slope)
     """
 
-    shadows, slope, sia = terrain.shadows_and_slope(dsm, nbar.blue.time.values)
+    shadows, slope, sia = terrain.shadows_and_slope(dsm, nbar.blue.time.values, shadow_method=shadow_method,
+                                                    solar_vec=solar_vec)
 
     shadowy = dilate(shadows != terrain.LIT) | (sia < constants.LOW_SOLAR_INCIDENCE_THRESHOLD_DEGREES)
 
@@ -0,0 +1,142 @@
+"""
+Background indexing of output datasets, so that database latency doesn't hold up task submission.
+"""
+from __future__ import absolute_import
+
+import logging
+import threading
+import time
+from collections import Counter
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+from wofs import profiling
+
+_LOG = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class IndexWriter(object):
+    """
+    Adds datasets to the index from a background thread, in batches.
+
+    Each batch is added in one transaction, where the index supports that (otherwise dataset by dataset,
+    so that the batch size makes no difference, e.g. with datacube 1.5).
+    If a batch fails, its datasets are retried individually, so that one bad dataset doesn't fail the others.
+    Adding blocks while the queue is full (backpressure), and closing flushes the queue.
+
+    The tasks whose datasets could not be indexed are collected in failed, and those whose datasets
+    have all been indexed can be had from pop_indexed (e.g. to record them as done only then).
+    """
+    def __init__(self, index, batch_size=50, queue_size=500, sources_policy='skip', records=None):
+        self.batch_size = batch_size
+        self.sources_policy = sources_policy
+        self.records = records  # for profiling of the index_add stage
+        self.indexed = 0
+        self.failed = set()
+        self._outstanding = Counter()  # datasets queued of each task
+        self._completed = []  # tasks whose datasets were all indexed, since last popped
+        self._lock = threading.Lock()
+        self._index = index
+        if batch_size > 1 and not hasattr(index, 'transaction'):
+            _LOG.warning('The index does not support transactions, so datasets will be added one at a time '
+                         '(regardless of the batch size)')
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._run, name='index-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add(self, dataset, task=None):
+        """Queue a dataset (produced by the identified task) for indexing, waiting while the queue is full"""
+        self.add_all([dataset], task)
+
+    def add_all(self, datasets, task=None):
+        """Queue all the datasets of the identified task for indexing, waiting while the queue is full"""
+        if not self._thread.is_alive():
+            raise RuntimeError('Index writer is closed')
+        if task is not None:
+            with self._lock:
+                self._outstanding[task] += len(datasets)
+        for dataset in datasets:
+            self._queue.put((dataset, task))
+
+    def pop_indexed(self):
+        """Tasks whose datasets have all been indexed (successfully), since last called"""
+        with self._lock:
+            completed, self._completed = self._completed, []
+        return completed
+
+    def _done(self, task, success):
+        if task is None:
+            return
+        with self._lock:
+            if not success:
+                self.failed.add(task)
+            self._outstanding[task] -= 1
+            if not self._outstanding[task]:
+                del self._outstanding[task]
+                if task not in self.failed:
+                    self._completed.append(task)
+
+    def close(self):
+        """Index any queued datasets, and stop"""
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stopping = any(item is _STOP for item in batch)
+            batch = [item for item in batch if item is not _STOP]
+            if batch:
+                self._write(batch)
+
+    def _add(self, dataset, task):
+        try:
+            self._index.datasets.add(dataset, sources_policy=self.sources_policy)
+        except Exception as err:  # pylint: disable=broad-except
+            _LOG.exception('Indexing failed: id=%s path=%s: %s', dataset.id, dataset.local_path, err)
+            self._done(task, success=False)
+        else:
+            _LOG.info('Dataset added to index: id=%s path=%s', dataset.id, dataset.local_path)
+            self.indexed += 1
+            self._done(task, success=True)
+
+    def _write(self, batch):
+        start = time.time()
+        with profiling.stage('index_add', records=self.records):
+            if len(batch) > 1 and hasattr(self._index, 'transaction'):
+                try:
+                    with self._index.transaction():
+                        for dataset, _ in batch:
+                            self._index.datasets.add(dataset, sources_policy=self.sources_policy)
+                except Exception as err:  # pylint: disable=broad-except
+                    _LOG.warning('Batch of %d datasets failed to index (%s), retrying individually', len(batch), err)
+                    for dataset, task in batch:
+                        self._add(dataset, task)
+                else:
+                    self.indexed += len(batch)
+                    for dataset, task in batch:
+                        _LOG.info('Dataset added to index: id=%s path=%s', dataset.id, dataset.local_path)
+                        self._done(task, success=True)
+            else:
+                for dataset, task in batch:
+                    self._add(dataset, task)
+        _LOG.info('Indexed batch of %d datasets in %fs', len(batch), time.time() - start)
@@ -0,0 +1,126 @@
+"""
+On-disk record of the tasks of a job, so that a restarted job can resume without regenerating them.
+"""
+from __future__ import absolute_import
+
+import json
+import pickle
+import sqlite3
+import time
+import zlib
+
+PENDING = 'pending'
+RUNNING = 'running'
+INDEXING = 'indexing'  # written, but not yet confirmed as indexed
+DONE = 'done'
+FAILED = 'failed'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS cells (x INTEGER, y INTEGER, PRIMARY KEY (x, y));
+CREATE TABLE IF NOT EXISTS tasks (key TEXT PRIMARY KEY, x INTEGER, y INTEGER, status TEXT, updated REAL, task BLOB);
+"""
+
+
+class TaskManifest(object):
+    """
+    SQLite file of the tasks generated for each cell, with the status of each task.
+
+    Tasks are recorded a cell at a time (as compressed pickles), so that generation interrupted part way
+    can continue from the next cell. Once every cell has been recorded the manifest is complete,
+    and the unfinished tasks can be had without querying the index at all.
+    """
+    def __init__(self, path, query):
+        """
+        :param path: manifest file (created if necessary)
+        :param query: JSON-serialisable description of the job, which must match that of an existing manifest
+                      (or None, e.g. just to update the status of tasks)
+        """
+        self._db = sqlite3.connect(str(path))
+        self._db.executescript(_SCHEMA)
+        if query is not None:
+            query = json.dumps(query, sort_keys=True, default=str)
+            recorded = self._meta('query')
+            if recorded is None:
+                self._set_meta('query', query)
+            elif recorded != query:
+                raise ValueError('Manifest %s was made for a different job: %s' % (path, recorded))
+
+    def _meta(self, name):
+        row = self._db.execute('SELECT value FROM meta WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, name, value):
+        with self._db:
+            self._db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (name, value))
+
+    def setdefault(self, name, value):
+        """The (JSON-serialisable) value recorded under name, recording the given value if there is none"""
+        recorded = self._meta('job.' + name)
+        if recorded is None:
+            self._set_meta('job.' + name, json.dumps(value))
+            return value
+        return json.loads(recorded)
+
+    @property
+    def complete(self):
+        """Whether the tasks of every cell have been recorded"""
+        return self._meta('complete') == 'true'
+
+    def mark_complete(self):
+        self._set_meta('complete', 'true')
+
+    def cells(self):
+        """Indexes of the cells whose tasks have been recorded"""
+        return set(self._db.execute('SELECT x, y FROM cells'))
+
+    def add_cell(self, cell_index, tasks, key):
+        """Record the tasks of a cell (as pending), identifying each by key(task)"""
+        now = time.time()
+        rows = [(key(task), cell_index[0], cell_index[1], PENDING, now,
+                 sqlite3.Binary(zlib.compress(pickle.dumps(task, pickle.HIGHEST_PROTOCOL))))
+                for task in tasks]
+        with self._db:
+            self._db.executemany('INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?, ?, ?)', rows)
+            self._db.execute('INSERT OR IGNORE INTO cells VALUES (?, ?)', tuple(cell_index))
+
+    def unfinished(self):
+        """Yield the recorded tasks that are not done (e.g. pending, failed, or interrupted before being indexed)"""
+        keys = [key for key, in self._db.execute('SELECT key FROM tasks WHERE status != ? ORDER BY x, y, key',
+                                                 (DONE,))]
+        for key in keys:
+            blob, = self._db.execute('SELECT task FROM tasks WHERE key = ?', (key,)).fetchone()
+            yield pickle.loads(zlib.decompress(blob))
+
+    def keys(self, *statuses):
+        """Keys of the tasks with any of the statuses"""
+        marks = ', '.join('?' * len(statuses))
+        return {key for key, in self._db.execute('SELECT key FROM tasks WHERE status IN (%s)' % marks, statuses)}
+
+    def set_status(self, key, status):
+        with self._db:
+            self._db.execute('UPDATE tasks SET status = ?, updated = ? WHERE key = ?', (status, time.time(), key))
+
+    def counts(self):
+        """Number of tasks with each status"""
+        return dict(self._db.execute('SELECT status, COUNT(*) FROM tasks GROUP BY status'))
+
+    def close(self):
+        self._db.close()
+
+
+def manifest_tasks(manifest, cell_tasks, key):
+    """
+    Yield the unfinished tasks recorded in the manifest, then those of any cells not yet recorded.
+
+    :param cell_tasks: function generating the (cell index, tasks) of all cells but skip_cells
+    :param key: function identifying a task
+    """
+    for task in manifest.unfinished():
+        yield task
+    if not manifest.complete:
+        for cell_index, tasks in cell_tasks(skip_cells=manifest.cells()):
+            manifest.add_cell(cell_index, tasks, key=key)
+            for task in tasks:
+                yield task
+        manifest.mark_complete()
@@ -0,0 +1,39 @@
+"""
+Storage options of the output files (WOfLs).
+"""
+from __future__ import absolute_import
+
+import numpy
+
+
+def measurement_dtype(product, name='water'):
+    """The dtype of a measurement, as defined by the product"""
+    return numpy.dtype(product.measurements[name]['dtype'])
+
+
+def netcdf_variable_params(params):
+    """
+    Options for creating a netCDF4 variable, from those configured.
+
+    The configured compression names the codec: zlib, none, or another that the netCDF4
+    library supports (e.g. zstd, bzip2 or blosc_lz4, with netCDF4 1.6+), at the given complevel.
+    Other options (e.g. chunksizes, fletcher32) pass through unchanged.
+    """
+    params = dict(params)
+    if 'compression' not in params:
+        return params
+    codec = str(params.pop('compression')).lower()
+    params.pop('zlib', None)
+    if codec in ('none', 'false'):
+        params['zlib'] = False
+        params.pop('complevel', None)
+    elif codec == 'zlib':
+        params['zlib'] = True
+    else:
+        params['compression'] = codec
+    return params
+
+
+def variable_params(config):
+    """netCDF4 options of each output variable, from the config"""
+    return {name: netcdf_variable_params(params) for name, params in config['variable_params'].items()}
@@ -0,0 +1,117 @@
+"""
+Optional instrumentation of the processing stages of a task.
+
+Stages are only measured while a profile is active (see run_profiled), so the
+instrumentation costs next to nothing otherwise. Each stage records wall time,
+CPU time (of the calling thread, where the platform supports it) and the peak
+resident memory of the process during the stage. The peak is measured on linux by
+resetting the high-water mark (via /proc/self/clear_refs) as each stage starts,
+having first noted it for the stages in progress. Where that isn't possible, the
+peak is instead that of the process so far (i.e. including any earlier tasks).
+
+A profile collects the stages entered by every thread of the process, which
+assumes (like the workers) only one task runs in each process at a time.
+"""
+from __future__ import absolute_import, division
+
+import json
+import os
+import resource
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+_RUSAGE_CPU = getattr(resource, 'RUSAGE_THREAD', resource.RUSAGE_SELF)
+_LOCK = threading.Lock()
+_ACTIVE = None  # stage records of the current profile, if any
+_PEAKS = {}  # peak memory (MB) so far of each stage in progress, while the high-water mark is being reset
+_RESETTABLE = os.access('/proc/self/clear_refs', os.W_OK)
+
+
+def _cpu_time():
+    usage = resource.getrusage(_RUSAGE_CPU)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _peak_rss_mb():
+    """High-water mark of the resident memory (since last reset, where supported)"""
+    if _RESETTABLE:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024  # kilobytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # kilobytes, on linux
+
+
+def _reset_peak():
+    """Note the peak memory so far for the stages in progress, and reset the high-water mark (with _LOCK held)"""
+    if _RESETTABLE:
+        peak = _peak_rss_mb()
+        for token in _PEAKS:
+            _PEAKS[token] = max(_PEAKS[token], peak)
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+
+
+@contextmanager
+def stage(name, records=None):
+    """Measure the enclosed code as the named stage, into records or else the active profile (if any)."""
+    records = _ACTIVE if records is None else records
+    if records is None:
+        yield
+        return
+
+    token = object()
+    with _LOCK:
+        _reset_peak()
+        _PEAKS[token] = 0.0
+    wall, cpu = time.time(), _cpu_time()
+    try:
+        yield
+    finally:
+        wall, cpu = time.time() - wall, _cpu_time() - cpu
+        with _LOCK:
+            peak = max(_PEAKS.pop(token), _peak_rss_mb())
+            records.append(dict(stage=name, wall=wall, cpu=cpu, peak_rss_mb=peak))
+
+
+def run_profiled(name, func, *args, **kwargs):
+    """
+    Call func with a profile active.
+
+    :return: the result of func, and a record of the name and stages of the task
+    """
+    global _ACTIVE  # pylint: disable=global-statement
+    records = _ACTIVE = []
+    try:
+        with stage('total'):
+            result = func(*args, **kwargs)
+    finally:
+        _ACTIVE = None
+    return result, dict(task=name, stages=records)
+
+
+def dumps(profile):
+    """JSON of a profile record (whose task name may be e.g. a tile index, including a datetime64)"""
+    return json.dumps(profile, default=str)
+
+
+def accumulate(totals, records):
+    """Add stage records into per-stage totals (of wall and CPU time, and the maximum peak memory)."""
+    for record in records:
+        total = totals.setdefault(record['stage'], OrderedDict(count=0, wall=0.0, cpu=0.0, peak_rss_mb=0.0))
+        total['count'] += 1
+        total['wall'] += record['wall']
+        total['cpu'] += record['cpu']
+        total['peak_rss_mb'] = max(total['peak_rss_mb'], record['peak_rss_mb'])
+    return totals
+
+
+def format_totals(totals):
+    """Tabulate per-stage totals, for the final summary"""
+    lines = ['%-16s %8s %10s %10s %12s' % ('stage', 'count', 'wall (s)', 'cpu (s)', 'peak (MB)')]
+    for name, total in totals.items():
+        lines.append('%-16s %8d %10.1f %10.1f %12.0f' % (name, total['count'], total['wall'], total['cpu'],
+                                                        total['peak_rss_mb']))
+    return '\n'.join(lines)
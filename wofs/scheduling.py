@@ -0,0 +1,188 @@
+"""
+Scheduling of tasks: placement on workers (so that each worker's caches, e.g. of a cell's terrain,
+get reused), and the number of tasks kept in flight.
+"""
+from __future__ import absolute_import, division
+
+import math
+import pickle
+import time
+from collections import Counter, OrderedDict, deque
+
+
+def task_cell(task):
+    """Cell index of a task (for either a tile or a stack)"""
+    tile_index = task['tile_indexes'][0] if 'tile_indexes' in task else task['tile_index']
+    return tuple(tile_index[:2])
+
+
+OPEN_CELLS = 4  # cells interleaved at once, i.e. the number of groups of workers (see CellAffinity)
+
+
+class CellAffinity(object):
+    """
+    Routes all tasks of a cell to the same group of workers.
+
+    The workers are split into (at most) a few groups, so that tasks of only as many cells need be
+    in flight to keep every worker busy, however many workers there are. With no more workers than
+    groups, each group is a single worker. A cell is assigned, when first seen, to the group with the
+    fewest outstanding tasks (then the fewest tasks overall), which keeps the load roughly balanced
+    as cells come and go.
+    """
+    def __init__(self, workers, groups=OPEN_CELLS):
+        self.max_groups = groups
+        self.workers = []
+        self.groups = []
+        self.cells = {}
+        self.outstanding = Counter()
+        self.assigned = Counter()
+        self.update(workers)
+
+    def submitted(self, cell_index):
+        """The group of workers for a task of the cell (counting it as outstanding), or None while there are none"""
+        if not self.groups:
+            return None
+        if cell_index not in self.cells:
+            self.cells[cell_index] = min(self.groups, key=lambda group: (self.outstanding[group],
+                                                                         self.assigned[group]))
+        group = self.cells[cell_index]
+        self.outstanding[group] += 1
+        self.assigned[group] += 1
+        return group
+
+    def completed(self, group):
+        if group is not None:
+            self.outstanding[group] -= 1
+
+    def update(self, workers):
+        """Follow workers joining (which then get new cells) and leaving (whose cells are reassigned)"""
+        self.workers = sorted(workers)
+        count = min(self.max_groups, len(self.workers))
+        self.groups = [tuple(self.workers[i::count]) for i in range(count)]
+        self.cells = {cell: group for cell, group in self.cells.items() if group in self.groups}
+
+    def load(self, cell_index):
+        """Outstanding tasks of the group that a task of the cell would go to"""
+        if cell_index in self.cells:
+            return self.outstanding[self.cells[cell_index]]
+        return min([self.outstanding[group] for group in self.groups] or [0])
+
+    def imbalance(self):
+        """Ratio of the most tasks assigned to one group, to the mean (1 being perfectly balanced)"""
+        counts = [self.assigned[group] for group in self.groups]
+        total = sum(counts)
+        return max(counts) * len(counts) / total if total else 1.0
+
+
+class CellQueue(object):
+    """
+    Iterates over a stream of tasks ordered cell by cell, interleaving several cells (one per group of workers).
+
+    With cell affinity, taking the tasks in order would put (nearly) every task in flight on the
+    workers of the current cell. Instead, the stream is read ahead until there are tasks of as many
+    cells as groups (i.e. at most OPEN_CELLS, so that only a few cells' tasks are held at once),
+    and the next task is taken from the open cell whose group is least loaded (the oldest such cell, on a tie).
+    """
+    def __init__(self, tasks, affinity):
+        self.affinity = affinity
+        self._tasks = iter(tasks)
+        self._open = OrderedDict()  # tasks (read but not yet taken) of each cell
+        self._exhausted = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while not self._exhausted and len(self._open) < max(1, len(self.affinity.groups)):
+            task = next(self._tasks, None)
+            if task is None:
+                self._exhausted = True
+            else:
+                self._open.setdefault(task_cell(task), deque()).append(task)
+        if not self._open:
+            raise StopIteration
+        cell = min(self._open, key=self.affinity.load)
+        task = self._open[cell].popleft()
+        if not self._open[cell]:
+            del self._open[cell]
+        return task
+
+    next = __next__  # python 2
+
+
+def worker_threads(workers):
+    """Total threads of the workers (from the scheduler info)"""
+    return sum(worker.get('nthreads', worker.get('ncores', 1)) for worker in workers.values())
+
+
+def cache_hit_ratio(stats):
+    """Overall hit ratio of caches, from their stats (e.g. of each worker)"""
+    hits = sum(stat['hits'] for stat in stats)
+    lookups = hits + sum(stat['misses'] for stat in stats)
+    return hits / lookups if lookups else None
+
+
+class AdaptiveWindow(object):
+    """
+    Number of tasks to keep in flight: enough to keep every worker busy, with a minimal backlog.
+
+    Beyond one task per worker, the backlog must cover the time the submit loop takes to generate
+    and submit a replacement for a completed task, i.e. (by Little's law) the throughput times that
+    refill time, which is tracked conservatively (decaying slowly from its peaks). The window is
+    also capped by a budget for the (pickled) size of the tasks in flight, which the scheduler holds
+    in memory, and by a fixed maximum.
+    """
+    def __init__(self, workers, maximum, memory_budget_mb=1024, sample_every=50):
+        self.workers = max(1, workers)
+        self.maximum = maximum
+        self.memory_budget = memory_budget_mb * 2 ** 20
+        self.sample_every = sample_every
+        self.interval = None  # mean seconds between completions
+        self.latency = None  # mean seconds from submission to completion
+        self.refill_time = 0.0
+        self.task_bytes = None
+        self.submitted = 0
+        self.completed = 0
+        self._last_completion = None
+
+    @staticmethod
+    def _smooth(mean, value, weight=0.1):
+        return value if mean is None else (1 - weight) * mean + weight * value
+
+    def record_submission(self, task, seconds):
+        """Note the time taken to generate and submit a task (and occasionally, its size)"""
+        self.refill_time = max(0.9 * self.refill_time, seconds)
+        if self.submitted % self.sample_every == 0:
+            self.task_bytes = self._smooth(self.task_bytes, len(pickle.dumps(task, pickle.HIGHEST_PROTOCOL)))
+        self.submitted += 1
+
+    def record_completion(self, latency, now=None):
+        """Note the completion of a task, and how long after its submission"""
+        now = time.time() if now is None else now
+        if self._last_completion is not None:
+            self.interval = self._smooth(self.interval, now - self._last_completion)
+        self._last_completion = now
+        self.latency = self._smooth(self.latency, latency)
+        self.completed += 1
+
+    @property
+    def throughput(self):
+        """Tasks completed per second (recently), or None if not yet known"""
+        return 1 / self.interval if self.interval else None
+
+    @property
+    def size(self):
+        if self.throughput is None:
+            size = 2 * self.workers
+        else:
+            size = self.workers + max(1, int(math.ceil(2 * self.throughput * self.refill_time)))
+        if self.task_bytes:
+            size = min(size, int(self.memory_budget // self.task_bytes))
+        return max(1, min(size, self.maximum))
+
+    def describe(self):
+        throughput = self.throughput
+        return 'window %d, throughput %s tasks/min, latency %s' % (
+            self.size,
+            '%.1f' % (60 * throughput) if throughput else 'unknown',
+            '%.0fs' % self.latency if self.latency is not None else 'unknown')
@@ -5,6 +5,7 @@ from pandas import to_datetime
 from datacube.utils.geometry import CRS
 import math
 import xarray
+from wofs.cache import LRUCache
 
 UNKNOWN = -1
 LIT = 255
@@ -35,6 +36,54 @@ def _shade_row(shade_mask, elev_m, sun_alt_deg, pixel_scale_m, no_data, fuzz=0.0
 
     return shade_mask
 
+
+def _shade_rows(shade_mask, elev_m, sun_alt_deg, pixel_scale_m, no_data, fuzz=0.0):
+    """
+    shade every row of the elevation model (equivalent to _shade_row on each row)
+
+    Sweeps across the columns, for all rows at once, tracking the ray from the most recent
+    (unshaded) tip in each row. A ray from a later tip is always at least as high as those
+    before it, so only one needs to be kept. This is O(n) per row, with no per-tip allocation.
+    """
+
+    # threshold is TAN of sun's altitude
+    tan_sun_alt = math.tan(sun_alt_deg)
+    drop = tan_sun_alt * pixel_scale_m
+
+    # pure terrain angle shadow
+    shade_mask[:, 0] = LIT
+    shade_mask[:, 1:] = numpy.where((elev_m[:, :-1] - elev_m[:, 1:]) / pixel_scale_m < tan_sun_alt, LIT, SHADED)
+
+    # tips (light->shadow transitions)
+    tips = (shade_mask[:, :-1] == LIT) & (shade_mask[:, 1:] == SHADED)
+
+    rows, cols = elev_m.shape
+    tip_level = numpy.full(rows, -numpy.inf)  # elevation (plus fuzz) of the current tip in each row
+    tip_col = numpy.zeros(rows, dtype=numpy.int64)
+    distance = numpy.empty(rows, dtype=numpy.int64)
+    shadow_level = numpy.empty(rows)
+    shaded = numpy.empty(rows, dtype=bool)
+
+    for col in range(cols):
+        elevation = elev_m[:, col]
+        numpy.subtract(col, tip_col, out=distance)
+        numpy.multiply(distance, drop, out=shadow_level)
+        numpy.subtract(tip_level, shadow_level, out=shadow_level)
+        numpy.greater(shadow_level, elevation, out=shaded)
+
+        if col < cols - 1:
+            # project shadows from tips that are not already in shadow
+            new_tip = tips[:, col] & ~shaded
+            numpy.add(elevation, fuzz, out=tip_level, where=new_tip, dtype=numpy.float64)
+            tip_col[new_tip] = col
+            numpy.greater(tip_level, elevation, out=shaded, where=new_tip)
+
+        shade_mask[:, col][shaded] = SHADED
+
+    shade_mask[elev_m == no_data] = UNKNOWN
+
+    return shade_mask
+
 def vector_to_crs(point, vector, original_crs, destination_crs):
     """
     Transform a vector (in the tangent space of a particular point) to a new CRS 
@@ -69,33 +118,35 @@ def solar_vector(p, time, crs):
     sun = ephem.Sun(observer)
 
     sun_az = sun.az-vert_az
-    x = math.sin(sun_az)*math.cos(sun.alt)
-    y = -math.cos(sun_az)*math.cos(sun.alt)
-    z = math.sin(sun.alt)
+    return _direction(sun_az, sun.alt)
 
-    return x, y, z, sun_az, sun.alt
 
+def _direction(sun_az, sun_alt):
+    x = math.sin(sun_az)*math.cos(sun_alt)
+    y = -math.cos(sun_az)*math.cos(sun_alt)
+    z = math.sin(sun_alt)
 
-def shadows_and_slope(tile, time):
-    """
-    Terrain shadow masking (Greg's implementation) and slope masking.
+    return x, y, z, sun_az, sun_alt
 
-    Input: Digital Surface Model xarray DataSet (need metadata e.g. resolution, CRS)
 
-    Uses Sobel filter to estimate the slope gradients (assuming raster is non-rotated wrt. crs) and magnitude.
-    Ignores curvature of earth (picking middle of tile for solar elevation and azimuth) calculating surface incidence.
-    Reprojects (rotates/resamples) DSM to align rows with shadows (at 25m resolution,
-    and assuming the input projection is Mercator-like i.e. preserves bearings).
-    For each row, finds each threshold pixel (where the slope just turns away from the sun) and raytraces
-    (i.e. using a ramp, masks the other pixels shaded by the pillar of that pixel).
-    Reprojects shadow mask (and undoes border enlargement associated with the rotation).
+SHADOW_METHODS = ('rotate', 'sweep')
 
-    TODO (BL) -- profile, and explore numpy.minimum.accumulate (make-monotonic) style alternative
-                 and maybe fewer resamplings (or come up with something better still).
-    """
+GRADIENTS = ('xgrad', 'ygrad', 'norm_len', 'slope')
 
-    y_size, x_size = tile.elevation.shape
+# Memoization of shadow masks, for solar geometry quantised to the tolerance (disabled by default).
+# Keyed by the DSM extent, so typically holds one cell's shadows for a few sun positions.
+# Each entry is a float32 mask the size of the DSM (~80MB for a buffered 4000 pixel tile).
+SHADOW_CACHE = LRUCache(maxsize=0)
+SHADOW_TOLERANCE_DEGREES = 0.5
 
+
+def with_gradients(tile):
+    """
+    Attach the sun-independent terrain geometry (Sobel gradients, length of the terrain normal
+    vector, and slope in degrees) to the Digital Surface Model xarray DataSet, as extra variables.
+
+    These are reused by shadows_and_slope (e.g. when the same DSM is cached for many acquisitions).
+    """
     xgrad = ndimage.sobel(tile.elevation, axis=1) / abs(8*tile.affine.a)
     ygrad = ndimage.sobel(tile.elevation, axis=0) / abs(8*tile.affine.e)
 
@@ -107,30 +158,100 @@ def shadows_and_slope(tile, time):
 
     slope = numpy.degrees(numpy.arccos(1.0/norm_len))
 
+    dims = tile.elevation.dims
+    return tile.assign(xgrad=(dims, xgrad), ygrad=(dims, ygrad), norm_len=(dims, norm_len), slope=(dims, slope))
+
+
+def tile_solar_vector(tile, time):
+    """Solar vector at the middle of the (DSM) tile"""
+    y_size, x_size = tile.elevation.shape
     x, y = tile.dims.keys()
     tile_center = (tile[x].values[x_size//2], tile[y].values[y_size//2])
-    solar_vec = solar_vector(tile_center, to_datetime(time), tile.crs)
+    return solar_vector(tile_center, to_datetime(time), tile.crs)
+
+
+def shadows_and_slope(tile, time, shadow_method='rotate', solar_vec=None):
+    """
+    Terrain shadow masking (Greg's implementation) and slope masking.
+
+    Input: Digital Surface Model xarray DataSet (need metadata e.g. resolution, CRS),
+    optionally including the terrain GRADIENTS (see with_gradients).
+
+    Uses Sobel filter to estimate the slope gradients (assuming raster is non-rotated wrt. crs) and magnitude.
+    Ignores curvature of earth (picking middle of tile for solar elevation and azimuth) calculating surface incidence.
+    Shadows are cast by one of the SHADOW_METHODS:
+
+    rotate: Reprojects (rotates/resamples) DSM to align rows with shadows (at 25m resolution,
+    and assuming the input projection is Mercator-like i.e. preserves bearings).
+    For each row, finds each threshold pixel (where the slope just turns away from the sun) and raytraces
+    (i.e. using a ramp, masks the other pixels shaded by the pillar of that pixel).
+    The rows are traced together, sweeping across the columns (see _shade_rows).
+    Reprojects shadow mask (and undoes border enlargement associated with the rotation).
+
+    sweep: Traces the same ramps on the native grid, sweeping along the sun's azimuth (see _swept_shadows).
+    Avoids both resamplings (and their padded arrays).
+
+    If SHADOW_CACHE is enabled, shadows are instead cast with the azimuth and altitude rounded to
+    SHADOW_TOLERANCE_DEGREES, and reused for any other acquisition over the same DSM that rounds alike.
+
+    The solar vector may be given (e.g. that of the whole tile, when processing a block of it),
+    otherwise it is computed for the middle of the DSM.
+    """
+    if not all(name in tile for name in GRADIENTS):
+        tile = with_gradients(tile)
+    xgrad, ygrad, norm_len, slope = (tile[name].values for name in GRADIENTS)
+
+    x, y = tile.dims.keys()
+    if solar_vec is None:
+        solar_vec = tile_solar_vector(tile, time)
     sia = (solar_vec[2] - xgrad*solar_vec[0] - ygrad*solar_vec[1])/norm_len
     sia = 90-numpy.degrees(numpy.arccos(sia))
 
     # # TODO: water_band=SolarTerrainShadowSlope(self.dsm_path).filter(water_band)
+    pixel_scale_m = 25.0  # TODO: proper res
+    no_data = -1000
+
+    def cast_shadows(solar_vec):
+        if shadow_method == 'rotate':
+            return _rotated_shadows(tile.elevation.values, solar_vec, pixel_scale_m, no_data)
+        elif shadow_method == 'sweep':
+            return _swept_shadows(tile.elevation.values, solar_vec, pixel_scale_m, no_data, fuzz=10.0)
+        raise ValueError('Unknown shadow method: %s' % shadow_method)
+
+    if SHADOW_CACHE.maxsize:
+        step = math.radians(SHADOW_TOLERANCE_DEGREES)
+        sun_az, sun_alt = (round(angle / step) * step for angle in solar_vec[3:])
+        key = (shadow_method, float(tile[x].values[0]), float(tile[y].values[0]), tile.elevation.shape, sun_az, sun_alt)
+        # a copy, lest the (cropped) mask keep the whole padded rotation alive
+        shadows = SHADOW_CACHE.get(key, lambda: numpy.array(cast_shadows(_direction(sun_az, sun_alt)), copy=True))
+    else:
+        shadows = cast_shadows(solar_vec)
+
+    shadows = xarray.DataArray(shadows.reshape(tile.elevation.shape), coords=tile.elevation.coords)
+
+    return shadows, slope, sia
+
+
+def _rotated_shadows(elevation, solar_vec, pixel_scale_m, no_data):
+    """
+    Shadow mask, traced along the rows of a DSM rotated to align with the sun's azimuth.
+    """
+    y_size, x_size = elevation.shape
+
     rot_degrees = 90.0 + math.degrees(solar_vec[3])
     sun_alt_deg = math.degrees(solar_vec[4])
     # print solar_vec, rot_degrees, sun_alt_deg
-    pixel_scale_m = 25.0  # TODO: proper res
-    no_data = -1000
 
-    rotated_elv_array = ndimage.interpolation.rotate(tile.elevation.values,
+    rotated_elv_array = ndimage.interpolation.rotate(elevation,
                                                      rot_degrees,
                                                      reshape=True,
                                                      output=numpy.float32,
                                                      cval=no_data,
                                                      prefilter=False)
 
-    # create the shadow mask by ray-tracying along each row
+    # create the shadow mask by ray-tracing along each row
     shadows = numpy.zeros_like(rotated_elv_array)
-    for row in range(0, rotated_elv_array.shape[0]):
-        _shade_row(shadows[row], rotated_elv_array[row], solar_vec[4], pixel_scale_m, no_data, fuzz=10.0)
+    _shade_rows(shadows, rotated_elv_array, solar_vec[4], pixel_scale_m, no_data, fuzz=10.0)
 
     del rotated_elv_array
 
@@ -140,7 +261,63 @@ def shadows_and_slope(tile, time):
     dr = (shadows.shape[0] - y_size) // 2
     dc = (shadows.shape[1] - x_size) // 2
 
-    shadows = shadows[dr:dr + y_size, dc:dc + x_size]
-    shadows = xarray.DataArray(shadows.reshape(tile.elevation.shape), coords=tile.elevation.coords)
+    return shadows[dr:dr + y_size, dc:dc + x_size]
 
-    return shadows, slope, sia
+
+def _upstream(values, offset):
+    """
+    values[r + offset] for each row r, linearly interpolating fractional offsets (and clamped to the ends)
+    """
+    whole = int(math.floor(offset))
+    fraction = offset - whole
+    rows = numpy.arange(values.size) + whole
+
+    result = numpy.take(values, rows, mode='clip')
+    if fraction:
+        result = (1 - fraction) * result + fraction * numpy.take(values, rows + 1, mode='clip')
+    return result
+
+
+def _swept_shadows(elevation, solar_vec, pixel_scale_m, no_data, fuzz=0.0):
+    """
+    Shadow mask, traced on the native grid by sweeping along the sun's azimuth.
+
+    Sunlight is propagated one column (or row, whichever is closer to the azimuth) at a time.
+    The ray drifts by at most a pixel across the other axis per step (linearly interpolated).
+    Along each ray, tracks the horizon: the highest shadow ramp cast by the upstream tips (where
+    the terrain turns away from the sun, raised by the fuzz as for _shade_rows) or else the terrain.
+    """
+    shade_mask = numpy.empty(elevation.shape, dtype=numpy.float32)
+    shade_mask[...] = LIT
+
+    # direction of the sunlight, in (column, row) order: x is easting, y is southing
+    along, across = -solar_vec[0], -solar_vec[1]
+
+    # orient views of the arrays, such that light travels along increasing columns
+    elev, shade = elevation, shade_mask
+    if abs(across) > abs(along):
+        elev, shade, along, across = elev.T, shade.T, across, along
+    if along < 0:
+        elev, shade, along = elev[:, ::-1], shade[:, ::-1], -along
+
+    if along:
+        drift = across / along  # rows per column step
+        drop = math.tan(solar_vec[4]) * pixel_scale_m * math.hypot(1.0, drift)  # ramp descent per step
+
+        horizon = elev[:, 0].astype(numpy.float64)  # height of shadow ramps (or terrain, where higher)
+        for col in range(1, elev.shape[1]):
+            surface = elev[:, col]
+            elev_up = _upstream(elev[:, col - 1], -drift)
+
+            # pure terrain angle shadow
+            facing_away = elev_up - surface >= drop
+
+            # project shadows from tips (light->shadow transition)
+            ramp = numpy.maximum(_upstream(horizon, -drift), elev_up + fuzz * facing_away) - drop
+
+            shade[:, col][facing_away | (ramp > surface)] = SHADED
+            horizon = numpy.maximum(ramp, surface)
+
+    shade_mask[elevation == no_data] = UNKNOWN
+
+    return shade_mask
@@ -0,0 +1,27 @@
+from __future__ import absolute_import
+
+from wofs import benchmark
+
+
+def test_benchmark_records_and_comparison():
+    results = benchmark.run(sizes=[64], dtypes=['int16', 'float32'], roughnesses=[0, 100], shadow_methods=['sweep'],
+                            benchmarks=['classify', 'pq_filter'], repeat=1)
+
+    assert [(record['benchmark'], record['params']) for record in results] == [
+        ('classify', dict(dtype='int16', size=64)),
+        ('pq_filter', dict(size=64)),
+        ('classify', dict(dtype='float32', size=64))]
+    assert all(record['best'] > 0 and record['peak_traced_mb'] > 0 for record in results)
+
+    ratios = benchmark.compare(results, results)
+    assert [record['ratio'] for record in ratios] == [1.0] * 3
+
+
+def test_benchmark_output_codecs():
+    results = benchmark.run_io(sizes=[64], codecs=['none', 'zlib:4'], dtypes=['uint8', 'int16'], repeat=1)
+
+    assert [(record['benchmark'], record['params']['codec'], record['params']['dtype']) for record in results] == [
+        (name, codec, dtype) for codec in ['none', 'zlib:4'] for dtype in ['uint8', 'int16']
+        for name in ['write_wofl', 'read_wofl']]
+    size = {(record['params']['codec'], record['params']['dtype']): record['bytes'] for record in results}
+    assert size['zlib:4', 'uint8'] < size['none', 'uint8'] < size['none', 'int16']
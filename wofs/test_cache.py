@@ -0,0 +1,27 @@
+from __future__ import absolute_import
+
+from wofs.cache import LRUCache
+
+
+def test_lru_cache_evicts_least_recently_used():
+    computed = []
+
+    def compute(key):
+        return lambda: computed.append(key) or key * 10
+
+    cache = LRUCache(maxsize=2)
+    assert cache.get(1, compute(1)) == 10
+    assert cache.get(2, compute(2)) == 20
+    assert cache.get(1, compute(1)) == 10
+    assert cache.get(3, compute(3)) == 30  # evicts 2
+    assert cache.get(2, compute(2)) == 20
+
+    assert computed == [1, 2, 3, 2]
+    assert cache.stats() == dict(hits=1, misses=4, size=2, maxsize=2)
+
+
+def test_lru_cache_disabled():
+    cache = LRUCache(maxsize=0)
+    assert cache.get('a', lambda: 1) == 1
+    assert cache.get('a', lambda: 2) == 2
+    assert cache.stats()['size'] == 0
@@ -0,0 +1,100 @@
+from __future__ import absolute_import
+
+import numpy
+import pytest
+import xarray
+
+from wofs import classifier
+
+
+def synthetic_bands(shape=(300, 200), seed=0):
+    """Six int16 bands spanning the tree thresholds, with some nodata and zero-sum ratio pixels."""
+    rng = numpy.random.RandomState(seed)
+    images = rng.randint(-50, 2500, size=(6,) + shape).astype(numpy.int16)
+    images[:, rng.rand(*shape) < 0.3] //= 8  # darker pixels, to reach the water leaves
+    images[:, rng.rand(*shape) < 0.02] = -999
+    images[:, rng.rand(*shape) < 0.02] = 0
+    return images
+
+
+def as_dataarray(images):
+    bands, rows, cols = images.shape
+    return xarray.DataArray(images, coords=[numpy.arange(bands), numpy.arange(rows), numpy.arange(cols)],
+                            dims=['band', 'y', 'x'])
+
+
+@pytest.mark.parametrize('float64', [False, True])
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_fused_matches_masks(seed, float64):
+    images = as_dataarray(synthetic_bands(seed=seed))
+
+    expected = classifier.classify(images, float64=float64, backend='masks')
+    result = classifier.classify(images, float64=float64, backend='fused')
+
+    assert result.dtype == numpy.uint8
+    assert set(numpy.unique(expected.values)) == {0, 128}
+    assert numpy.array_equal(result.values, expected.values)
+
+
+@pytest.mark.parametrize('block_size', [1, 150, 1000, 10 ** 6])
+def test_fused_block_boundaries(block_size):
+    images = synthetic_bands(seed=3).astype(numpy.float32)
+
+    expected = classifier._classify_masks(images)
+    result = classifier._classify_fused(images, block_size=block_size)
+
+    assert numpy.array_equal(result, expected)
+
+
+@pytest.mark.parametrize('backend', ['fused', 'integer', 'masks'])
+def test_classifies_stack(backend):
+    stack = numpy.stack([synthetic_bands(seed=seed) for seed in range(3)], axis=1)
+    images = xarray.DataArray(stack, dims=['band', 'time', 'y', 'x'])
+
+    result = classifier.classify(images, backend=backend)
+
+    assert result.dims == ('time', 'y', 'x')
+    for i in range(3):
+        assert numpy.array_equal(result.values[i], classifier._classify_masks(stack[:, i]))
+
+
+def test_classify_dataset_bands():
+    images = as_dataarray(synthetic_bands(seed=4))
+    dataset = images.to_dataset(dim='band').rename(dict(enumerate(classifier.BANDS)))
+
+    result = classifier.classify(dataset)
+
+    assert result.dims == ('y', 'x')
+    assert numpy.array_equal(result.values, classifier.classify(images, backend='masks').values)
+
+
+def test_classify_numpy_bands():
+    images = synthetic_bands(seed=5)
+    expected = classifier._classify_masks(images)
+
+    assert numpy.array_equal(classifier.classify(images), expected)
+    assert numpy.array_equal(classifier.classify(dict(zip(classifier.BANDS, images))), expected)
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_integer_matches_float32(seed):
+    images = synthetic_bands(seed=seed)
+    # pixels whose ratios land on either side of (or just round onto) the ndi_52 thresholds
+    rows, cols = numpy.indices(images.shape[1:])
+    images[1, :100] = 1 + rows[:100] * cols[:100] % 5000
+    images[4, :100] = numpy.round(images[1, :100] * ((1 - 0.01) / (1 + 0.01))) + (cols[:100] % 3 - 1)
+
+    expected = classifier.classify(images, backend='masks')
+    result = classifier.classify(images, backend='integer')
+
+    assert numpy.array_equal(result, expected)
+
+
+def test_integer_ratio_test_matches_float32_exhaustively():
+    a, b = [band.ravel().astype(numpy.int16) for band in numpy.mgrid[-300:300, -300:300]]
+    bands = {4: a, 1: b}
+    index = numpy.arange(a.size)
+    for threshold in [-0.23, -0.01, 0.12, 0.23, 0.34, 0.5]:
+        ratio = (a.astype(numpy.float32) - b) / (a.astype(numpy.float32) + b)
+        expected = ratio <= numpy.float32(threshold)
+        assert numpy.array_equal(classifier._integer_test('ndi_52', threshold, bands, index), expected)
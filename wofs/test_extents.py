@@ -0,0 +1,61 @@
+from __future__ import absolute_import
+
+from collections import namedtuple
+
+import numpy
+import pytest
+from datacube.utils.geometry import CRS, BoundingBox, box
+
+from wofs import extents
+from wofs.cache import LRUCache
+
+Dataset = namedtuple('Dataset', ['id', 'extent'])
+Tile = namedtuple('Tile', ['sources'])
+
+
+class Extent(object):
+    """Extent of a dataset, counting its reprojections"""
+    def __init__(self, *bounds):
+        self.geometry = box(*bounds, crs=CRS('EPSG:3577'))
+        self.reprojections = []
+
+    def to_crs(self, crs):
+        self.reprojections.append(str(crs))
+        return self.geometry  # as if reprojected
+
+
+def tile(*datasets):
+    sources = numpy.empty(1, dtype=object)
+    sources[0] = datasets
+    return Tile(sources)
+
+
+@pytest.mark.parametrize('bounds, separated', [
+    ([(0, 0, 10, 10), (5, 5, 15, 15), (8, -5, 20, 8)], None),  # overlapping
+    ([(0, 0, 10, 10), (10, 0, 20, 10)], None),  # touching along an edge
+    ([(0, 0, 10, 10), (10, 10, 20, 20)], None),  # touching at a corner
+    ([(0, 0, 10, 10), (11, 0, 20, 10)], (1, 0)),  # disjoint along x
+    ([(0, 0, 10, 10), (0, 12, 10, 20)], (1, 0)),  # disjoint along y
+    ([(0, 0, 10, 10), (5, 0, 15, 10), (12, 0, 20, 10)], (2, 0)),  # overlapping pairwise, but not all
+])
+def test_separated_bounds(bounds, separated):
+    bounds = [BoundingBox(*box_bounds) for box_bounds in bounds]
+    expected = separated and tuple(bounds[i] for i in separated)
+    assert extents.separated_bounds(bounds) == expected
+
+
+def test_tile_extent_reprojects_each_dataset_once(monkeypatch):
+    monkeypatch.setattr(extents, 'EXTENT_CACHE', LRUCache(maxsize=100))
+    dsm = Dataset('dsm', Extent(0, 0, 100, 100))
+    scenes = [Dataset('scene%d' % i, Extent(100 * i - 50, -20, 100 * i + 50, 120)) for i in range(3)]
+    albers, wgs84 = CRS('EPSG:3577'), CRS('EPSG:4326')
+
+    for crs in [albers, wgs84, albers]:
+        union = extents.tile_extent(tile(dsm), crs)
+        for first, second in zip(scenes, scenes[1:]):
+            extents.tile_extent(tile(first, second), crs)
+            extents.tile_extent(tile(second, first), crs)  # the same union
+
+    assert extents.tile_extent(tile(dsm), albers) is union
+    for dataset in [dsm] + scenes:
+        assert sorted(dataset.extent.reprojections) == sorted([str(albers), str(wgs84)])
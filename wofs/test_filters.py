@@ -0,0 +1,61 @@
+from __future__ import absolute_import
+
+import numpy
+import pytest
+import scipy.ndimage
+import xarray
+
+from wofs import filters
+
+
+def disk():
+    radius = filters.DILATION_RADIUS
+    y, x = numpy.ogrid[-radius:radius + 1, -radius:radius + 1]
+    return x * x + y * y <= (radius + 0.5) ** 2
+
+
+@pytest.mark.parametrize('density', [0.0005, 0.02, 0.3])
+@pytest.mark.parametrize('shape', [(1, 1), (2, 9), (7, 7), (150, 230)])
+def test_dilate_matches_disk_kernel(shape, density):
+    mask = numpy.random.RandomState(0).random_sample(shape) < density
+    mask[0, -1] = True  # exercise the edges
+
+    expected = scipy.ndimage.binary_dilation(mask, structure=disk())
+    assert numpy.array_equal(filters.dilate(mask), expected)
+
+
+def test_dilate_bits_dilates_each_plane_separately():
+    rng = numpy.random.RandomState(1)
+    cloud = rng.random_sample((120, 90)) < 0.01
+    shadow = rng.random_sample((120, 90)) < 0.01
+    flags = numpy.uint8(64) * cloud | numpy.uint8(32) * shadow
+
+    dilated = filters.dilate_bits(flags)
+
+    assert dilated.dtype == numpy.uint8
+    assert numpy.array_equal(dilated & 64 != 0, scipy.ndimage.binary_dilation(cloud, structure=disk()))
+    assert numpy.array_equal(dilated & 32 != 0, scipy.ndimage.binary_dilation(shadow, structure=disk()))
+    assert not (dilated & ~numpy.uint8(96)).any()
+
+
+def reference_pq_filter(pq):
+    ipq = ~pq
+    masking = numpy.zeros(ipq.shape, dtype=numpy.uint8)
+    masking[(ipq & (filters.PQA_SATURATION_BITS | filters.PQA_CONTIGUITY_BITS)) != 0] = 2
+    masking[(ipq & filters.PQA_SEA_WATER_BIT) != 0] += 4
+    masking[scipy.ndimage.binary_dilation(ipq & filters.PQA_CLOUD_BITS, structure=disk())] += 64
+    masking[scipy.ndimage.binary_dilation(ipq & filters.PQA_CLOUD_SHADOW_BITS, structure=disk())] += 32
+    return masking
+
+
+def test_pq_filter_lookup_matches_reference():
+    rng = numpy.random.RandomState(2)
+    clear = numpy.int16(0x3FFF)  # all tests passed, land
+    pq = numpy.where(rng.random_sample((80, 100)) < 0.9, clear, rng.randint(-2 ** 15, 2 ** 15, (80, 100)))
+    pq = xarray.DataArray(pq.astype(numpy.int16), dims=('y', 'x'),
+                          coords={'y': numpy.arange(80.0), 'x': numpy.arange(100.0)})
+
+    result = filters.pq_filter(pq)
+
+    assert result.dims == ('y', 'x')
+    assert numpy.array_equal(result.values, reference_pq_filter(pq.values))
@@ -0,0 +1,94 @@
+from __future__ import absolute_import
+
+import contextlib
+import threading
+from collections import namedtuple
+
+from wofs.indexing import IndexWriter
+
+Dataset = namedtuple('Dataset', 'id local_path')
+
+
+class FakeIndex(object):
+    """Stand-in for a datacube index, with (optional) transactions that roll back on failure"""
+    def __init__(self, bad_ids=(), transactions=True):
+        self.added = []
+        self.transactions = []
+        self.bad_ids = set(bad_ids)
+        self.datasets = self
+        self._pending = None
+        if transactions:
+            self.transaction = self._transaction
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        self._pending = []
+        try:
+            yield
+            self.added.extend(self._pending)
+            self.transactions.append(len(self._pending))
+        finally:
+            self._pending = None
+
+    def add(self, dataset, sources_policy):
+        assert sources_policy == 'skip'
+        if dataset.id in self.bad_ids:
+            raise ValueError('bad dataset')
+        (self.added if self._pending is None else self._pending).append(dataset.id)
+
+
+def test_index_writer_batches_in_transactions():
+    index = FakeIndex()
+    blocker = threading.Event()
+    real_add = index.add
+
+    def add(dataset, sources_policy):
+        if dataset.id == 0:
+            blocker.wait()  # hold the writer while the other datasets queue up
+        real_add(dataset, sources_policy)
+
+    index.add = add
+    writer = IndexWriter(index, batch_size=4, queue_size=100)
+    for i in range(10):
+        writer.add(Dataset(i, 'path%d' % i), task=i)
+    blocker.set()
+    writer.close()
+
+    assert sorted(index.added) == list(range(10))
+    assert max(index.transactions) == 4  # at least six queued behind the first batch
+    assert writer.indexed == 10 and not writer.failed
+
+
+def test_index_writer_isolates_failures():
+    index = FakeIndex(bad_ids={3, 7})
+    with IndexWriter(index, batch_size=5) as writer:
+        for i in range(10):
+            writer.add(Dataset(i, 'path%d' % i), task=i // 2)
+
+    assert sorted(index.added) == [0, 1, 2, 4, 5, 6, 8, 9]
+    assert writer.failed == {1, 3}
+    assert writer.indexed == 8
+
+
+def test_index_writer_without_transactions(caplog):
+    index = FakeIndex(bad_ids={2}, transactions=False)
+    with IndexWriter(index, batch_size=3, queue_size=1) as writer:
+        for i in range(6):
+            writer.add(Dataset(i, 'path%d' % i), task=i)
+
+    assert index.added == [0, 1, 3, 4, 5]
+    assert writer.failed == {2}
+    assert [record.levelname for record in caplog.records].count('WARNING') == 1
+    assert 'does not support transactions' in caplog.text
+
+
+def test_index_writer_reports_tasks_once_indexed():
+    index = FakeIndex(bad_ids={3})
+    with IndexWriter(index, batch_size=2) as writer:
+        writer.add_all([Dataset(0, 'path0'), Dataset(1, 'path1')], task='a')
+        writer.add_all([Dataset(2, 'path2'), Dataset(3, 'path3')], task='b')
+        writer.add_all([Dataset(4, 'path4')], task='c')
+
+    assert sorted(writer.pop_indexed()) == ['a', 'c']  # not b, one of whose datasets failed
+    assert writer.failed == {'b'}
+    assert writer.pop_indexed() == []
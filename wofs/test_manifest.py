@@ -0,0 +1,64 @@
+from __future__ import absolute_import
+
+import pytest
+
+from wofs.manifest import TaskManifest, manifest_tasks, DONE, FAILED, INDEXING, PENDING, RUNNING
+
+CELLS = {(15, -40): ['a', 'b'], (15, -41): ['c'], (16, -40): []}
+
+
+def cell_tasks(skip_cells=(), interrupt_after=None):
+    for count, cell_index in enumerate(sorted(CELLS)):
+        if count == interrupt_after:
+            raise KeyboardInterrupt
+        if cell_index not in skip_cells:
+            yield cell_index, [dict(name=name) for name in CELLS[cell_index]]
+
+
+def key(task):
+    return task['name']
+
+
+def test_manifest_records_and_resumes(tmpdir):
+    path = str(tmpdir.join('manifest.db'))
+    manifest = TaskManifest(path, query=dict(year=2000))
+
+    tasks = list(manifest_tasks(manifest, cell_tasks, key))
+    assert [task['name'] for task in tasks] == ['c', 'a', 'b']  # in order of cell index
+    assert manifest.complete
+    assert manifest.counts() == {PENDING: 3}
+
+    manifest.set_status('a', DONE)
+    manifest.set_status('b', FAILED)
+    manifest.set_status('c', RUNNING)  # interrupted
+
+    def unexpected(skip_cells):
+        raise AssertionError('should not regenerate tasks')
+
+    resumed = TaskManifest(path, query=dict(year=2000))
+    assert [task['name'] for task in manifest_tasks(resumed, unexpected, key)] == ['c', 'b']
+    assert resumed.keys(RUNNING, INDEXING) == {'c'}
+    assert resumed.keys(DONE, FAILED) == {'a', 'b'}
+
+
+def test_manifest_continues_interrupted_generation(tmpdir):
+    path = str(tmpdir.join('manifest.db'))
+    manifest = TaskManifest(path, query=None)
+    with pytest.raises(KeyboardInterrupt):
+        list(manifest_tasks(manifest, lambda skip_cells: cell_tasks(skip_cells, interrupt_after=1), key))
+    assert not manifest.complete
+    assert manifest.cells() == {(15, -41)}
+
+    tasks = list(manifest_tasks(TaskManifest(path, query=None), cell_tasks, key))
+    assert sorted(task['name'] for task in tasks) == ['a', 'b', 'c']
+
+
+def test_manifest_rejects_different_job(tmpdir):
+    path = str(tmpdir.join('manifest.db'))
+    manifest = TaskManifest(path, query=dict(year=2000))
+    assert manifest.setdefault('task_timestamp', 123) == 123
+    manifest.close()
+
+    assert TaskManifest(path, query=None).setdefault('task_timestamp', 456) == 123
+    with pytest.raises(ValueError):
+        TaskManifest(path, query=dict(year=2001))
@@ -0,0 +1,11 @@
+from __future__ import absolute_import
+
+from wofs.output import netcdf_variable_params
+
+
+def test_netcdf_variable_params():
+    configured = dict(compression='zlib', complevel=4, chunksizes=[1, 200, 200])
+    assert netcdf_variable_params(configured) == dict(zlib=True, complevel=4, chunksizes=[1, 200, 200])
+    assert netcdf_variable_params(dict(compression='zstd', complevel=3)) == dict(compression='zstd', complevel=3)
+    assert netcdf_variable_params(dict(compression='none', zlib=True, complevel=4)) == dict(zlib=False)
+    assert netcdf_variable_params(dict(zlib=True, fletcher32=True)) == dict(zlib=True, fletcher32=True)
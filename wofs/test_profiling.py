@@ -0,0 +1,67 @@
+from __future__ import absolute_import
+
+import json
+
+import numpy
+import pytest
+
+from wofs import profiling
+
+
+def test_stage_is_inert_without_profile():
+    with profiling.stage('classify'):
+        pass
+    assert profiling._ACTIVE is None
+
+
+def test_run_profiled_records_stages():
+    def task(value):
+        with profiling.stage('classify'):
+            sum(range(10000))
+        with profiling.stage('write'):
+            pass
+        return value * 2
+
+    result, profile = profiling.run_profiled((15, -40), task, 21)
+
+    assert result == 42
+    assert profile['task'] == (15, -40)
+    assert [record['stage'] for record in profile['stages']] == ['classify', 'write', 'total']
+    assert all(record['wall'] >= 0 and record['peak_rss_mb'] > 0 for record in profile['stages'])
+    assert profiling._ACTIVE is None
+
+    totals = profiling.accumulate(profiling.accumulate({}, profile['stages']), profile['stages'])
+    assert totals['classify']['count'] == 2
+    assert 'classify' in profiling.format_totals(totals)
+
+
+def test_run_profiled_deactivates_on_failure():
+    def task():
+        raise RuntimeError('boom')
+
+    with pytest.raises(RuntimeError):
+        profiling.run_profiled('failing', task)
+    assert profiling._ACTIVE is None
+
+
+def test_profile_of_tile_index_serialises():
+    tile_index = (15, -40, numpy.datetime64('2010-06-15T00:30:00.000000000'))
+    for name in [tile_index, [tile_index, tile_index]]:
+        _, profile = profiling.run_profiled(name, lambda: None)
+        assert '2010-06-15T00:30:00' in str(json.loads(profiling.dumps(profile))['task'])
+
+
+@pytest.mark.skipif(not profiling._RESETTABLE, reason='needs a resettable high-water mark')
+def test_peak_memory_is_per_stage():
+    def task():
+        with profiling.stage('large'):
+            with profiling.stage('allocate'):
+                numpy.ones(2 ** 28, dtype=numpy.uint8)  # 256MB
+            with profiling.stage('small'):
+                numpy.ones(2 ** 20, dtype=numpy.uint8)
+
+    _, profile = profiling.run_profiled('task', task)
+    peaks = {record['stage']: record['peak_rss_mb'] for record in profile['stages']}
+
+    assert peaks['allocate'] > peaks['small'] + 200
+    assert peaks['large'] >= peaks['allocate'] and peaks['total'] >= peaks['allocate']
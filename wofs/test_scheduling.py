@@ -0,0 +1,132 @@
+from __future__ import absolute_import
+
+from collections import deque
+
+from wofs.scheduling import (OPEN_CELLS, AdaptiveWindow, CellAffinity, CellQueue, cache_hit_ratio, task_cell,
+                             worker_threads)
+
+
+def test_task_cell():
+    assert task_cell(dict(tile_index=(15, -40, 't0'))) == (15, -40)
+    assert task_cell(dict(tile_indexes=[(16, -41, 't0'), (16, -41, 't1')])) == (16, -41)
+
+
+def test_cell_affinity_keeps_cells_on_one_worker():
+    affinity = CellAffinity(['w2', 'w1'])
+
+    first = [affinity.submitted((15, -40)) for _ in range(3)]
+    second = affinity.submitted((15, -41))  # least loaded worker
+    assert first == [('w1',)] * 3 and second == ('w2',)
+
+    for _ in range(3):
+        affinity.completed(('w1',))
+    assert affinity.submitted((16, -40)) == ('w1',)  # now idle
+    assert affinity.submitted((15, -41)) == ('w2',)  # sticky
+
+    assert affinity.assigned == {('w1',): 4, ('w2',): 2}
+    assert affinity.imbalance() == 4 / 3.0
+
+
+def test_cell_affinity_groups_workers():
+    affinity = CellAffinity(['w%d' % i for i in range(10)], groups=4)
+    assert [len(group) for group in affinity.groups] == [3, 3, 2, 2]
+    assert sorted(sum(affinity.groups, ())) == affinity.workers
+
+
+def test_cache_hit_ratio():
+    assert cache_hit_ratio([dict(hits=3, misses=1), dict(hits=0, misses=4)]) == 3 / 8.0
+    assert cache_hit_ratio([dict(hits=0, misses=0)]) is None
+
+
+def test_adaptive_window():
+    window = AdaptiveWindow(workers=4, maximum=100)
+    assert window.size == 8 and window.throughput is None  # until tasks complete
+
+    for second in range(10):
+        window.record_completion(latency=30, now=float(second) / 2)
+    assert window.throughput == 2.0
+    assert window.size == 5  # one spare task, when replacements are quick
+
+    window.record_submission(dict(tile_index=(15, -40, 't0')), seconds=3)
+    assert window.size == 4 + 12  # cover 2 tasks/s for twice the refill time
+    assert 'throughput 120.0 tasks/min' in window.describe()
+
+    assert AdaptiveWindow(workers=4, maximum=3).size == 3
+
+    window = AdaptiveWindow(workers=4, maximum=100, memory_budget_mb=1)
+    window.record_submission(dict(data=b'x' * 2 ** 18), seconds=0)  # ~quarter of the budget
+    assert window.size == 3
+
+
+def simulate(stream, workers):
+    """Cell-ordered tasks through a CellQueue and AdaptiveWindow, completing the oldest task in flight each second"""
+    affinity = CellAffinity(workers)
+    window = AdaptiveWindow(workers=worker_threads(workers), maximum=10000)
+    tasks = CellQueue(stream, affinity)
+
+    in_flight = deque()
+    cells = {}
+    busy = []  # groups with tasks in flight, each second
+
+    def fill():
+        while len(in_flight) < window.size:
+            task = next(tasks, None)
+            if task is None:
+                return
+            group = affinity.submitted(task_cell(task))
+            cells.setdefault(task_cell(task), set()).add(group)
+            in_flight.append(group)
+
+    fill()
+    now = 0.0
+    while in_flight:
+        busy.append(set(in_flight))
+        affinity.completed(in_flight.popleft())
+        now += 1.0
+        window.record_completion(latency=window.size, now=now)
+        fill()
+
+    assert sum(affinity.assigned.values()) == len(stream)
+    assert all(len(assigned) == 1 for assigned in cells.values())  # cells stick to a group
+    return affinity, busy
+
+
+def test_cell_ordered_stream_uses_every_worker():
+    # tasks generated a cell at a time, each worker having a couple of threads
+    stream = [dict(tile_index=(15 + cell, -40, 't%d' % i)) for cell in range(8) for i in range(30)]
+    workers = {'w%d' % i: dict(nthreads=2) for i in range(4)}
+    affinity, busy = simulate(stream, workers)
+
+    assert affinity.groups == [('w0',), ('w1',), ('w2',), ('w3',)]
+    assert set(affinity.groups) in busy  # all at once, not just in turn
+    assert affinity.imbalance() < 1.5
+
+
+def test_cell_queue_reads_ahead_a_few_cells():
+    # e.g. 32 nodes of 16 workers, with a few hundred tasks per cell
+    stream = (dict(tile_index=(15 + cell, -40, 't%d' % i)) for cell in range(12) for i in range(300))
+    read = []
+    workers = {'tcp://10.0.%d.%d:8786' % (node, i): dict(nthreads=1) for node in range(32) for i in range(16)}
+    tasks = CellQueue((read.append(task) or task for task in stream), CellAffinity(workers))
+
+    next(tasks)
+    assert len(read) == (OPEN_CELLS - 1) * 300 + 1  # whole cells, but for one task of the last
+
+    affinity, busy = simulate([dict(tile_index=(15 + cell, -40, 't%d' % i)) for cell in range(12)
+                               for i in range(300)], workers)
+    assert len(affinity.groups) == OPEN_CELLS
+    assert sum(len(group) for group in affinity.groups) == 512
+    assert set(affinity.groups) in busy  # all groups (so all workers) at once
+
+
+def test_cell_affinity_follows_workers():
+    affinity = CellAffinity([])
+    assert affinity.submitted((15, -40)) is None  # none connected yet
+
+    affinity.update({'w1': {}})
+    assert affinity.submitted((15, -40)) == ('w1',)
+    affinity.update({'w1': {}, 'w2': {}})
+    assert affinity.submitted((15, -41)) == ('w2',)  # newly joined
+
+    affinity.update({'w2': {}})
+    assert affinity.submitted((15, -40)) == ('w2',)  # reassigned, as w1 left
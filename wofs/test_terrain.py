@@ -0,0 +1,113 @@
+from __future__ import absolute_import
+
+import math
+
+import numpy
+import pytest
+import xarray
+
+from wofs import terrain
+from wofs.cache import LRUCache
+
+NO_DATA = -1000
+
+
+def ridges(shape):
+    rows, cols = numpy.indices(shape)
+    return 300 * numpy.abs(numpy.sin(cols / 17.0 + rows / 41.0)) + 50 * numpy.cos(cols / 5.0)
+
+
+def cones(shape):
+    rng = numpy.random.RandomState(0)
+    rows, cols = numpy.indices(shape)
+    dem = numpy.zeros(shape)
+    for row, col, height in zip(rng.randint(0, shape[0], 12), rng.randint(0, shape[1], 12), rng.randint(50, 900, 12)):
+        dem = numpy.maximum(dem, height - 25 * numpy.hypot(rows - row, cols - col))
+    return dem
+
+
+def plateaus(shape):
+    rng = numpy.random.RandomState(1)
+    rows, cols = numpy.indices(shape)
+    return 100.0 * ((cols // 23 + rows // 31) % 4) + 40 * rng.randint(0, 2, shape)
+
+
+@pytest.mark.parametrize('fuzz', [0.0, 10.0])
+@pytest.mark.parametrize('sun_alt', [0.15, 0.4, 0.7])
+@pytest.mark.parametrize('surface', [ridges, cones, plateaus])
+def test_shade_rows_matches_shade_row(surface, sun_alt, fuzz):
+    shape = (60, 250)
+    dem = (numpy.round(surface(shape) * 8) / 8).astype(numpy.float32)  # exactly representable elevations
+    dem[:, :5] = NO_DATA
+    dem[17, 100:120] = NO_DATA
+
+    expected = numpy.zeros_like(dem)
+    for row in range(shape[0]):
+        terrain._shade_row(expected[row], dem[row], sun_alt, 25.0, NO_DATA, fuzz=fuzz)
+
+    result = terrain._shade_rows(numpy.zeros_like(dem), dem, sun_alt, 25.0, NO_DATA, fuzz=fuzz)
+
+    assert (expected == terrain.SHADED).any() and (expected == terrain.LIT).any()
+    assert numpy.array_equal(result, expected)
+
+
+@pytest.mark.parametrize('azimuth', [0, 90, 180, 270])
+def test_swept_shadows_cast_away_from_sun(azimuth):
+    # a 250 metre cliff facing away from the sun, at 45 degrees altitude, shades 10 pixels (with 10 metres fuzz)
+    dem = numpy.zeros((80, 80), dtype=numpy.float32)
+    dem[:, :30] = 250
+    quarters = 3 - azimuth // 90  # turns anticlockwise, from a sun in the west
+    dem = numpy.rot90(dem, k=quarters)
+
+    azimuth, altitude = numpy.radians(azimuth), numpy.radians(45)
+    solar_vec = (numpy.sin(azimuth) * numpy.cos(altitude), -numpy.cos(azimuth) * numpy.cos(altitude),
+                 numpy.sin(altitude), azimuth, altitude)
+
+    shadows = terrain._swept_shadows(dem, solar_vec, 25.0, NO_DATA, fuzz=10.0)
+    shadows = numpy.rot90(shadows, k=-quarters)
+
+    assert (shadows[:, 30:40] == terrain.SHADED).all()
+    assert (shadows[:, :30] == terrain.LIT).all() and (shadows[:, 40:] == terrain.LIT).all()
+
+
+def dsm(origin=0.0):
+    coords = dict(y=origin - 25.0 * numpy.arange(80), x=origin + 25.0 * numpy.arange(80))
+    return xarray.Dataset(dict(elevation=(('y', 'x'), cones((80, 80)).astype(numpy.float32))), coords=coords,
+                          attrs=dict(crs=None))
+
+
+@pytest.fixture
+def shadow_cache(monkeypatch):
+    # sun (azimuth, altitude) in degrees, by minute of acquisition
+    geometry = {0: (100.0, 30.0), 1: (100.1, 30.1), 2: (103.0, 30.0)}
+    monkeypatch.setattr(terrain, 'solar_vector',
+                        lambda p, time, crs: terrain._direction(*map(math.radians, geometry[time.minute])))
+    cache = LRUCache(maxsize=4)
+    monkeypatch.setattr(terrain, 'SHADOW_CACHE', cache)
+    return cache
+
+
+@pytest.mark.parametrize('shadow_method', terrain.SHADOW_METHODS)
+def test_shadow_cache(shadow_cache, shadow_method):
+    first, second, other = (numpy.datetime64('2010-06-15T00:%02d' % minute) for minute in range(3))
+    tile = dsm()
+
+    shadows = terrain.shadows_and_slope(tile, first, shadow_method)[0].values
+    assert (shadows == terrain.SHADED).any()
+    assert shadow_cache.stats()['misses'] == 1
+
+    # within the tolerance
+    assert numpy.array_equal(terrain.shadows_and_slope(tile, second, shadow_method)[0].values, shadows)
+    assert shadow_cache.stats()['hits'] == 1
+
+    # another sun position, or another DSM
+    terrain.shadows_and_slope(tile, other, shadow_method)
+    terrain.shadows_and_slope(dsm(origin=2000.0), first, shadow_method)
+    assert shadow_cache.stats() == dict(hits=1, misses=3, size=3, maxsize=4)
+
+    # the same, whichever acquisition filled the cache
+    shadow_cache.clear()
+    assert numpy.array_equal(terrain.shadows_and_slope(tile, second, shadow_method)[0].values, shadows)
+
+    # entries don't keep larger (e.g. padded) arrays alive
+    assert all(value.base is None for value in shadow_cache._items.values())
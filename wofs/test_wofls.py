@@ -0,0 +1,75 @@
+from __future__ import absolute_import
+
+import numpy
+import pytest
+
+from wofs import benchmark, constants, filters, terrain, wofls
+
+
+@pytest.fixture
+def tile(monkeypatch):
+    # the sun's azimuth varies across the cell, so blocks must use that of the whole tile
+    def solar_vector(p, time, crs):
+        return terrain._direction(1.0 + (p[0] - benchmark.ORIGIN[0]) / 1e5, 0.4)
+    monkeypatch.setattr(terrain, 'solar_vector', solar_vector)
+
+    size = 96
+    return benchmark.synthetic_nbar(size), benchmark.synthetic_pq(size), benchmark.synthetic_dsm(size, 600)
+
+
+@pytest.mark.parametrize('block_size', [40, (30, 96)])
+def test_blocks_match_whole_tile(tile, block_size):
+    expected = wofls.woffles(*tile, shadow_method='sweep')
+    result = wofls.woffles_blocks(*tile, block_size=block_size, shadow_method='sweep')
+
+    assert (expected.values & constants.MASKED_TERRAIN_SHADOW).any()
+    assert numpy.array_equal(result.values, expected.values)
+
+
+def test_blocks_compute_gradients_per_window(tile):
+    # as for a lazily loaded DSM, versus the whole tile's gradients (as cached)
+    nbar, pq, dsm = tile
+    expected = wofls.woffles(nbar, pq, terrain.with_gradients(dsm), shadow_method='sweep')
+    result = wofls.woffles_blocks(nbar, pq, dsm, block_size=40, shadow_method='sweep')
+
+    assert numpy.array_equal(result.values, expected.values)
+
+
+def test_blocks_need_sweep(tile):
+    with pytest.raises(ValueError):
+        wofls.woffles_blocks(*tile, block_size=40, shadow_method='rotate')
+
+
+@pytest.mark.parametrize('shadow_method', terrain.SHADOW_METHODS)
+@pytest.mark.parametrize('threads', [2, 4])
+@pytest.mark.parametrize('row_bands', [True, False])
+def test_threads_match_whole_tile(tile, shadow_method, threads, row_bands):
+    expected = wofls.woffles(*tile, shadow_method=shadow_method)
+    block_size = wofls.row_bands(tile[0], threads) if row_bands else 40
+    result = wofls.woffles_blocks(*tile, block_size=block_size, threads=threads, shadow_method=shadow_method)
+
+    assert (expected.values & constants.MASKED_TERRAIN_SHADOW).any()
+    assert numpy.array_equal(result.values, expected.values)
+
+
+def test_threads_share_the_terrain(tile, monkeypatch):
+    calls = []
+    terrain_filter = filters.terrain_filter
+
+    def counted(dsm, *args, **kwargs):
+        calls.append(dsm.elevation.shape)
+        return terrain_filter(dsm, *args, **kwargs)
+    monkeypatch.setattr(filters, 'terrain_filter', counted)
+
+    wofls.woffles_blocks(*tile, block_size=wofls.row_bands(tile[0], 4), threads=4)
+    assert calls == [tile[2].elevation.shape]  # once, for the whole tile
+
+    wofls.woffles_blocks(*tile, block_size=wofls.row_bands(tile[0], 4), threads=1)
+    assert len(calls) == 1 + 4  # per band, each with its halo
+
+
+def test_row_bands():
+    nbar = benchmark.synthetic_nbar(96)
+    assert wofls.row_bands(nbar, 1) == (96, 96)
+    assert wofls.row_bands(nbar, 4) == (24, 96)
+    assert wofls.row_bands(nbar, 5) == (20, 96)  # the last band is shorter
@@ -15,23 +15,161 @@ Issues:
     - DSM may have different natural resolution to EO source.
       Should think about what CRS to compute in, and what resampling methods to use.
       Also, should quantify whether earth's curvature is significant on tile scale.
-    - Yet to profile memory, CPU or IO usage.
+    - Stages can be profiled (wall, CPU and peak memory) per task, see the profiling module.
+    - Block mode (woffles_blocks) bounds memory by the block size, but recomputes the
+      terrain within the (large) shadow halo of each block, and needs the sweep shadow method
+      (unless threaded, which computes the terrain for the whole tile instead).
 """
 from __future__ import absolute_import
 
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
-from wofs import classifier, filters
+import xarray
+from wofs import classifier, filters, profiling, terrain
+
+SHADOW_HALO_METRES = 6850  # worst case terrain shadow length, as per the DSM tile buffer (see wofs_app)
+
+
+def woffles(source, pq, dsm, shadow_method='rotate', classifier_backend='fused', solar_vec=None):
+    """
+    Generate a Water Observation Feature Layer from NBAR, PQ and surface elevation inputs.
+
+    The solar vector defaults to that of the middle of the DSM.
+    """
+    water = _pixel_flags(source, pq, classifier_backend)
+    with profiling.stage('terrain_filter'):
+        shadowy = filters.terrain_filter(dsm, source, shadow_method=shadow_method, solar_vec=solar_vec)
+
+    water = water | shadowy
+
+    assert water.dtype == np.uint8
+
+    return water
+
+
+def _pixel_flags(source, pq, classifier_backend):
+    """Water classified, and flagged by the EO and PQ filters (i.e. all but the terrain filter)"""
+    with profiling.stage('classify'):
+        water = classifier.classify(source, backend=classifier_backend)
+    with profiling.stage('eo_filter'):
+        nodata = filters.eo_filter(source)
+    with profiling.stage('pq_filter'):
+        cloudy = filters.pq_filter(pq.pqa)
+    return water | nodata | cloudy
 
 
-def woffles(source, pq, dsm):
-    """Generate a Water Observation Feature Layer from NBAR, PQ and surface elevation inputs."""
+def woffles_stack(source, pq, dsm, shadow_method='rotate', classifier_backend='fused'):
+    """
+    Generate Water Observation Feature Layers for a (time, y, x) stack of NBAR and PQ over one cell.
 
-    water = classifier.classify(source.to_array(dim='band')) \
-            | filters.eo_filter(source) \
-            | filters.pq_filter(pq.pqa) \
-            | filters.terrain_filter(dsm, source)
+    The decision tree and the nodata filter are evaluated for the whole stack at once.
+    The PQ and terrain filters are applied per acquisition, sharing the DSM (and its gradients).
+    Acquisitions are matched by position (rather than timestamp) along the time dimension.
+    """
+    with profiling.stage('classify'):
+        water = classifier.classify(source, backend=classifier_backend)
+    with profiling.stage('eo_filter'):
+        water = water | filters.eo_filter(source)
+
+    for i in range(source.time.size):
+        with profiling.stage('pq_filter'):
+            cloudy = filters.pq_filter(pq.pqa.isel(time=i))
+        with profiling.stage('terrain_filter'):
+            shadowy = filters.terrain_filter(dsm, source.isel(time=i), shadow_method=shadow_method)
+        water.values[i] |= (cloudy | shadowy).sel(y=water.y, x=water.x).values
 
     assert water.dtype == np.uint8
 
     return water
 
+
+def woffles_blocks(source, pq, dsm, block_size=1000, shadow_method='sweep', classifier_backend='fused',
+                   threads=1):
+    """
+    Generate a Water Observation Feature Layer, one block of the source tile at a time.
+
+    Each block is processed from the matching window of the inputs, which (where available)
+    extends beyond the block by a halo: the dilation radius for PQ, and additionally the Sobel
+    stencil and the worst case shadow length for the DSM. Inputs may be lazily loaded (dask),
+    in which case only the current windows are read into memory.
+
+    The block size is either a number of pixels (square blocks) or a (rows, columns) pair,
+    e.g. to split the tile into full-width row bands.
+
+    Every block uses the solar vector of the whole tile (i.e. the middle of the DSM),
+    as woffles would, lest the terrain filters differ from block to block. Only the sweep
+    shadow method is supported: rotate resamples each (differently sized) DSM window
+    differently, so its shadows would not match those of woffles near the block edges.
+
+    With more than one thread, the terrain filter is instead computed once for the whole tile
+    (with either shadow method), as it is the costliest stage, mostly holds the GIL, and would
+    be repeated over the overlapping halos. Only the per-pixel stages (classification, and the EO
+    and PQ filters) of the blocks are then processed concurrently, each thread writing to its own
+    part of the output (NumPy releasing the GIL for most of that arithmetic).
+    """
+    block_rows, block_cols = block_size if isinstance(block_size, tuple) else (block_size, block_size)
+    pq_halo = filters.DILATION_RADIUS
+    dsm_halo = filters.DILATION_RADIUS + 1 + int(np.ceil(SHADOW_HALO_METRES / _resolution(dsm.x)))
+
+    rows, cols = source.y.size, source.x.size
+    water = xarray.DataArray(np.empty((rows, cols), dtype=np.uint8), coords=[source.y, source.x])
+    shadowy = solar_vec = None
+    if threads > 1:
+        with profiling.stage('terrain_filter'):
+            shadowy = filters.terrain_filter(dsm, source, shadow_method=shadow_method)
+    elif shadow_method == 'sweep':
+        solar_vec = terrain.tile_solar_vector(dsm, source.blue.time.values)
+    else:
+        raise ValueError('Processing in blocks needs the sweep shadow method, not %s' % shadow_method)
+
+    def process(row, col):
+        with profiling.stage('load_nbar'):
+            block = source.isel(y=slice(row, row + block_rows), x=slice(col, col + block_cols)).load()
+        with profiling.stage('load_pq'):
+            pq_window = _window(pq, block, pq_halo).load()
+        if shadowy is None:
+            with profiling.stage('load_dsm'):
+                dsm_window = _window(dsm, block, dsm_halo).load()
+            result = woffles(block, pq_window, dsm_window,
+                             shadow_method=shadow_method,
+                             classifier_backend=classifier_backend,
+                             solar_vec=solar_vec)
+        else:
+            result = _pixel_flags(block, pq_window, classifier_backend) | shadowy
+        water[row:row + block_rows, col:col + block_cols] = result.sel(y=block.y, x=block.x).values
+
+    corners = [(row, col) for row in range(0, rows, block_rows) for col in range(0, cols, block_cols)]
+    if threads > 1:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            for future in [executor.submit(process, row, col) for row, col in corners]:
+                future.result()  # re-raise any failure
+    else:
+        for row, col in corners:
+            process(row, col)
+
+    return water
+
+
+def row_bands(source, threads):
+    """Block size splitting the source into one full-width band of rows per thread"""
+    return int(np.ceil(source.y.size / float(threads))), source.x.size
+
+
+def _resolution(coords):
+    return abs(float(coords[1] - coords[0]))
+
+
+def _span(coords, within, halo):
+    """Slice of coords covering the range of within, extended by a halo (of pixels)"""
+    margin = (halo + 0.5) * _resolution(coords)
+    lower = min(within[0], within[-1]) - margin
+    upper = max(within[0], within[-1]) + margin
+    inside = np.flatnonzero((coords > lower) & (coords < upper))
+    return slice(inside[0], inside[-1] + 1)
+
+
+def _window(data, like, halo):
+    """Part of the data (on the same grid) that covers like, plus a halo of pixels where available"""
+    return data.isel(y=_span(data.y.values, like.y.values, halo),
+                     x=_span(data.x.values, like.x.values, halo))
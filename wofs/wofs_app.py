@@ -7,15 +7,14 @@ from __future__ import absolute_import, print_function
 
 import copy
 import errno
+import functools
 import itertools
 import json
 import logging
 import os
-from collections import defaultdict
+import time
 from datetime import datetime
 from pathlib import Path
-import time
-import numpy as np
 import click
 import xarray
 from pandas import to_datetime
@@ -27,8 +26,11 @@ from datacube.ui import click as ui
 from datacube.compat import integer_types
 from datacube.model import Range
 from datacube.ui.task_app import task_app, task_app_options, check_existing_files
-from datacube.utils.geometry import unary_union, unary_intersection, CRS
-from wofs import wofls
+from datacube.utils.geometry import unary_intersection, box, CRS
+from wofs import wofls, terrain, classifier, profiling, indexing, scheduling, output
+from wofs.extents import tile_extent, separated_bounds
+from wofs.manifest import TaskManifest, manifest_tasks, RUNNING, INDEXING, DONE, FAILED
+from wofs.cache import LRUCache
 
 _LOG = logging.getLogger(__name__)
 
@@ -91,6 +93,9 @@ def make_wofs_config(index, config, dry_run=False, **query):
 
     config['wofs_dataset_type'] = get_product(index, config['product_definition'])
 
+    if config.get('block_size') and config.get('threads', 1) == 1 and config.get('shadow_method') != 'sweep':
+        raise ValueError('Processing in blocks (with block_size, unless threaded) needs shadow_method: sweep')
+
     if not os.access(config['location'], os.W_OK):
         _LOG.warning('Current user appears not have write access output location: %s', config['location'])
 
@@ -107,66 +112,113 @@ def get_filename(config, x, y, t):
     return Path(destination, filename)
 
 
-def group_tiles_by_cells(tile_index_list, cell_index_list):
-    key_map = defaultdict(list)
-    for x, y, t in tile_index_list:
-        if (x, y) in cell_index_list:
-            key_map[(x, y)].append((x, y, t))
-    return key_map
-
-
 def generate_tasks(index, config, time, extent=None):
     """
     Yield tasks (loadables (nbar,ps,dsm) + output targets), for dispatch to workers.
 
+    See generate_cell_tasks.
+    """
+    for _, tasks in generate_cell_tasks(index, config, time, extent):
+        for task in tasks:
+            yield task
+
+
+def generate_cell_tasks(index, config, time, extent=None, skip_cells=()):
+    """
+    Yield each cell index with its list of tasks, a cell at a time (other than any skip_cells).
+
     This function is the equivalent of an SQL join query,
     and is required as a workaround for datacube API abstraction layering.
+    The inputs are queried cell by cell, so that tasks are streamed rather than waiting on the whole extent.
+
+    If the config specifies a stack_size, the tiles of each cell are grouped into stacked tasks
+    (see do_wofs_stack_task) of up to that many acquisitions.
     """
     extent = extent if extent is not None else {}
     product = config['wofs_dataset_type']
+    stack_size = config.get('stack_size', 1)
 
     assert product.grid_spec.crs == CRS('EPSG:3577')
     assert all((abs(r) == 25) for r in product.grid_spec.resolution)  # ensure approx. 25 metre raster
     pq_padding = [3 * 25] * 2  # for 3 pixel cloud dilation
-    terrain_padding = [6850] * 2
+    terrain_padding = [wofls.SHADOW_HALO_METRES] * 2
     # Worst case shadow: max prominence (Kosciuszko) at lowest solar declination (min incidence minus slope threshold)
     # with snapping to pixel edges to avoid API questions
     # e.g. 2230 metres / math.tan(math.radians(30-12)) // 25 * 25 == 6850
 
     gw = datacube.api.GridWorkflow(index, grid_spec=product.grid_spec)  # GridSpec from product definition
 
-    wofls_loadables = gw.list_tiles(product=product.name, time=time, **extent)
     dsm_loadables = gw.list_cells(product='dsm1sv10', tile_buffer=terrain_padding, **extent)
 
-    for input_source in INPUT_SOURCES:
-        gqa_filter = dict(product=input_source['source_product'], time=time, gqa_iterative_mean_xy=(0,1))
-        nbar_loadables = gw.list_tiles(product=input_source['nbar'], time=time, source_filter=gqa_filter, **extent)
-        pq_loadables = gw.list_tiles(product=input_source['pq'], time=time, tile_buffer=pq_padding, **extent)
-
-        # only valid where EO, PQ and DSM are *all* available (and WOFL isn't yet)
-        tile_index_set = (set(nbar_loadables) & set(pq_loadables)) - set(wofls_loadables)
-        key_map = group_tiles_by_cells(tile_index_set, dsm_loadables)
-
-        # Cell index is X,Y, tile_index is X,Y,T
-        for cell_index, tile_indexes in key_map.items():
-            geobox = gw.grid_spec.tile_geobox(cell_index)
-            dsm_tile = gw.update_tile_lineage(dsm_loadables[cell_index])
-            for tile_index in tile_indexes:
+    # Cell index is X,Y, tile_index is X,Y,T
+    for cell_index in sorted(dsm_loadables):
+        if cell_index in skip_cells:
+            continue
+        geobox = gw.grid_spec.tile_geobox(cell_index)
+        dsm_tile = gw.update_tile_lineage(dsm_loadables[cell_index])
+        wofls_loadables = gw.list_tiles(cell_index, product=product.name, time=time)
+
+        tasks = []
+        for input_source in INPUT_SOURCES:
+            gqa_filter = dict(product=input_source['source_product'], time=time, gqa_iterative_mean_xy=(0, 1))
+            nbar_loadables = gw.list_tiles(cell_index, product=input_source['nbar'], time=time,
+                                           source_filter=gqa_filter)
+            pq_loadables = gw.list_tiles(cell_index, product=input_source['pq'], time=time, tile_buffer=pq_padding)
+
+            # only valid where EO, PQ and DSM are *all* available (and WOFL isn't yet)
+            tile_indexes = (set(nbar_loadables) & set(pq_loadables)) - set(wofls_loadables)
+
+            source_tasks = []
+            for tile_index in sorted(tile_indexes):
                 nbar_tile = gw.update_tile_lineage(nbar_loadables.pop(tile_index))
                 pq_tile = gw.update_tile_lineage(pq_loadables.pop(tile_index))
                 valid_region = find_valid_data_region(geobox, nbar_tile, pq_tile, dsm_tile)
                 if not valid_region.is_empty:
-                    yield dict(source_tile=nbar_tile,
-                               pq_tile=pq_tile,
-                               dsm_tile=dsm_tile,
-                               file_path=get_filename(config, *tile_index),
-                               tile_index=tile_index,
-                               extra_global_attributes=dict(platform=input_source['platform_name'],
-                                                            instrument=input_source['sensor_name']),
-                               valid_region=valid_region)
+                    source_tasks.append(dict(source_tile=nbar_tile,
+                                             pq_tile=pq_tile,
+                                             dsm_tile=dsm_tile,
+                                             file_path=get_filename(config, *tile_index),
+                                             tile_index=tile_index,
+                                             extra_global_attributes=dict(platform=input_source['platform_name'],
+                                                                          instrument=input_source['sensor_name']),
+                                             valid_region=valid_region))
+
+            if stack_size > 1:
+                source_tasks = list(stack_tasks(source_tasks, stack_size))
+            tasks.extend(source_tasks)
+
+        yield cell_index, tasks
 
 
-def make_wofs_tasks(index, config, year=None, **kwargs):
+def stack_tasks(tasks, stack_size):
+    """
+    Group tasks (for the same cell and input source) into tasks for stacks of up to stack_size tiles.
+    """
+    tasks = iter(tasks)
+    while True:
+        batch = list(itertools.islice(tasks, stack_size))
+        if not batch:
+            return
+        yield dict(source_tiles=[task['source_tile'] for task in batch],
+                   pq_tiles=[task['pq_tile'] for task in batch],
+                   dsm_tile=batch[0]['dsm_tile'],
+                   file_paths=[task['file_path'] for task in batch],
+                   tile_indexes=[task['tile_index'] for task in batch],
+                   extra_global_attributes=batch[0]['extra_global_attributes'],
+                   valid_regions=[task['valid_region'] for task in batch])
+
+
+def task_file_paths(task):
+    """Output file destinations of a task (for either a tile or a stack)"""
+    return task['file_paths'] if 'file_paths' in task else [task['file_path']]
+
+
+def task_key(task):
+    """Identify a task (by its outputs)"""
+    return ' '.join(str(file_path) for file_path in task_file_paths(task))
+
+
+def make_wofs_tasks(index, config, year=None, manifest=None, **kwargs):
     """
     Generate an iterable of 'tasks', matching the provided filter parameters.
 
@@ -177,6 +229,9 @@ def make_wofs_tasks(index, config, year=None, **kwargs):
      - a range of years
 
     Tasks can also be restricted to a given spatial region, specified in `kwargs['x']` and `kwargs['y']` in `EPSG:3577`.
+
+    If a manifest file is given, generated tasks are recorded in it, and (for a restarted job)
+    the unfinished tasks already recorded are resumed rather than regenerated.
     """
     # TODO: Filter query to valid options
     time = None
@@ -192,6 +247,15 @@ def make_wofs_tasks(index, config, year=None, **kwargs):
         extent['x'] = kwargs['x']
         extent['y'] = kwargs['y']
 
+    if manifest:
+        manifest = TaskManifest(manifest, query=dict(year=year, extent=extent,
+                                                     product=config['product_definition']['name'],
+                                                     stack_size=config.get('stack_size', 1)))
+        # outputs of a resumed job keep the version of the original
+        config['task_timestamp'] = manifest.setdefault('task_timestamp', config['task_timestamp'])
+        return manifest_tasks(manifest, functools.partial(generate_cell_tasks, index, config, time, extent),
+                              key=task_key)
+
     tasks = generate_tasks(index, config, time=time, extent=extent)
     return tasks
 
@@ -211,16 +275,39 @@ def get_app_metadata(config):
 
 
 def find_valid_data_region(geobox, *sources_list):
-    # perform work in CRS of the output tile geobox
-    unfused = [[dataset.extent.to_crs(geobox.crs) for dataset in tile.sources.item()]
-               for tile in sources_list]
-    # fuse the dataset extents within each source tile
-    tiles_extents = map(unary_union, unfused)
+    # perform work in CRS of the output tile geobox, fusing the dataset extents within each source tile
+    extents = [geobox.extent] + [tile_extent(tile, geobox.crs) for tile in sources_list]
+
+    # short-circuit where the bounding boxes alone show the extents don't all overlap
+    separated = separated_bounds([extent.boundingbox for extent in extents])
+    if separated:
+        first, second = separated
+        return box(*first, crs=geobox.crs).intersection(box(*second, crs=geobox.crs))
+
     # find where (within the output tile) that all prerequisite inputs available
-    return unary_intersection([geobox.extent] + list(tiles_extents))
+    return unary_intersection(extents)
     # downstream should check if this is empty..
 
 
+# Per-worker cache of each cell's DSM and terrain gradients, which do not depend on acquisition time
+TERRAIN_CACHE = LRUCache(maxsize=1)
+
+
+BANDS = classifier.BANDS  # inputs needed from EO data
+
+
+def terrain_key(dsm_tile):
+    """Identify a (buffered) DSM tile by its extent and source datasets"""
+    return (tuple(dsm_tile.geobox.extent.boundingbox),
+            tuple(sorted(str(dataset.id) for dataset in dsm_tile.sources.values[0])))
+
+
+def load_terrain(dsm_tile):
+    """Load a DSM tile, attaching its sun-independent terrain gradients"""
+    dsm = datacube.api.GridWorkflow.load(dsm_tile, resampling='cubic')
+    return terrain.with_gradients(dsm.isel(time=0))
+
+
 def docvariable(agdc_dataset, time):
     """
     Convert datacube dataset to xarray/NetCDF variable
@@ -231,6 +318,52 @@ def docvariable(agdc_dataset, time):
     return docarray
 
 
+def get_terrain(config, dsm_tile, dask_chunks=None):
+    """
+    The DSM tile (with terrain gradients), from the worker's cache if possible.
+
+    If chunked (i.e. for block mode), the DSM is instead loaded lazily and not cached,
+    its gradients being computed for each window of it as that is read.
+    """
+    TERRAIN_CACHE.maxsize = config.get('terrain_cache_size', 1)
+    terrain.SHADOW_CACHE.maxsize = config.get('shadow_cache_size', 0)
+    terrain.SHADOW_TOLERANCE_DEGREES = config.get('shadow_tolerance_degrees', terrain.SHADOW_TOLERANCE_DEGREES)
+    if dask_chunks:
+        return datacube.api.GridWorkflow.load(dsm_tile, resampling='cubic', dask_chunks=dask_chunks).isel(time=0)
+    return TERRAIN_CACHE.get(terrain_key(dsm_tile), lambda: load_terrain(dsm_tile))
+
+
+def worker_cache_stats():
+    """Statistics of the caches of a worker (see wofs_app --cell-affinity)"""
+    return dict(terrain=TERRAIN_CACHE.stats(), shadow=terrain.SHADOW_CACHE.stats())
+
+
+def distributed_client(executor):
+    """The dask distributed client behind a datacube executor, or None (e.g. for the serial executor)"""
+    client = getattr(executor, '_executor', None)
+    return client if hasattr(client, 'scheduler_info') else None
+
+
+def report_affinity(client, affinity):
+    """Log the cache hit ratios of the workers, and the balance of tasks between them"""
+    stats = client.run(worker_cache_stats)
+    for group in affinity.groups:
+        _LOG.info('Workers %s: %d tasks', ', '.join(group), affinity.assigned[group])
+    for worker, worker_stats in sorted(stats.items()):
+        _LOG.info('Worker %s: caches %s', worker, worker_stats)
+    for cache in ['terrain', 'shadow']:
+        ratio = scheduling.cache_hit_ratio([worker_stats[cache] for worker_stats in stats.values()])
+        if ratio is not None:
+            click.echo('%s cache hit ratio: %.2f' % (cache.capitalize(), ratio))
+    click.echo('Load imbalance (most tasks on a group of workers, relative to the mean): %.2f' % affinity.imbalance())
+
+
+def algorithm_options(config):
+    """Keyword arguments for the wofls functions, as configured"""
+    return dict(shadow_method=config.get('shadow_method', 'rotate'),
+                classifier_backend=config.get('classifier_backend', 'fused'))
+
+
 def do_wofs_task(config, source_tile, pq_tile, dsm_tile, file_path, tile_index, extra_global_attributes, valid_region):
     """
     Load data, run WOFS algorithm, attach metadata, and write output.
@@ -245,32 +378,100 @@ def do_wofs_task(config, source_tile, pq_tile, dsm_tile, file_path, tile_index,
     :return: Dataset objects representing the generated data that can be added to the index
     :rtype: list(datacube.model.Dataset)
     """
-    product = config['wofs_dataset_type']
-    app_info = get_app_metadata(config)
-
     if file_path.exists():
         raise OSError(errno.EEXIST, 'Output file already exists', str(file_path))
 
+    # load data (lazily, if processing in blocks)
+    block_size = config.get('block_size')
+    threads = config.get('threads', 1)
+    dask_chunks = {'time': 1, 'y': block_size, 'x': block_size} if block_size else None
+    with profiling.stage('load_nbar'):
+        source = datacube.api.GridWorkflow.load(source_tile, measurements=BANDS, dask_chunks=dask_chunks)
+    with profiling.stage('load_pq'):
+        pq = datacube.api.GridWorkflow.load(pq_tile, dask_chunks=dask_chunks)
+    with profiling.stage('load_dsm'):
+        # (with threads, the terrain is computed for the whole tile)
+        dsm = get_terrain(config, dsm_tile, dask_chunks if threads == 1 else None)
+
+    # Core computation
+    inputs = [x.isel(time=0) for x in [source, pq]] + [dsm]
+    options = algorithm_options(config)
+    if block_size or threads > 1:
+        result = wofls.woffles_blocks(*inputs, block_size=block_size or wofls.row_bands(source, threads),
+                                      threads=threads, **options)
+    else:
+        result = wofls.woffles(*inputs, **options)
+    if terrain.SHADOW_CACHE.maxsize:
+        _LOG.info('Shadow cache: %(hits)d hits, %(misses)d misses', terrain.SHADOW_CACHE.stats())
+
+    return [write_wofl(config, result, source.time, source.crs, source_tile, pq_tile, dsm_tile,
+                       file_path, extra_global_attributes, valid_region)]
+
+
+def do_wofs_stack_task(config, source_tiles, pq_tiles, dsm_tile, file_paths, tile_indexes,
+                       extra_global_attributes, valid_regions):
+    """
+    Load a stack of acquisitions over one cell, run WOFS algorithm on all of them, and write each output.
+
+    Parameters are as for do_wofs_task, except that there are lists of NBAR and PQ tiles,
+    output file destinations, tile indexes and valid regions (one for each acquisition),
+    sharing a DSM tile. Processing in blocks is not supported.
+
+    :return: Dataset objects representing the generated data that can be added to the index
+    :rtype: list(datacube.model.Dataset)
+    """
+    for file_path in file_paths:
+        if file_path.exists():
+            raise OSError(errno.EEXIST, 'Output file already exists', str(file_path))
+    if config.get('block_size') or config.get('threads', 1) > 1:
+        _LOG.warning('Stacked tasks process whole tiles: ignoring block_size and threads')
+
     # load data
-    bands = ['blue', 'green', 'red', 'nir', 'swir1', 'swir2']  # inputs needed from EO data)
-    source = datacube.api.GridWorkflow.load(source_tile, measurements=bands)
-    pq = datacube.api.GridWorkflow.load(pq_tile)
-    dsm = datacube.api.GridWorkflow.load(dsm_tile, resampling='cubic')
+    with profiling.stage('load_nbar'):
+        source = xarray.concat([datacube.api.GridWorkflow.load(tile, measurements=BANDS) for tile in source_tiles],
+                               dim='time')
+    with profiling.stage('load_pq'):
+        pq = xarray.concat([datacube.api.GridWorkflow.load(tile) for tile in pq_tiles], dim='time')
+    with profiling.stage('load_dsm'):
+        dsm = get_terrain(config, dsm_tile)
 
     # Core computation
-    result = wofls.woffles(*(x.isel(time=0) for x in [source, pq, dsm])).astype(np.int16)
+    result = wofls.woffles_stack(source, pq, dsm, **algorithm_options(config))
+
+    return [write_wofl(config, result.isel(time=i), source.time[i:i + 1], source.crs, source_tile, pq_tile,
+                       dsm_tile, file_path, extra_global_attributes, valid_region)
+            for i, (source_tile, pq_tile, file_path, valid_region)
+            in enumerate(zip(source_tiles, pq_tiles, file_paths, valid_regions))]
+
+
+def write_wofl(config, water, time, crs, source_tile, pq_tile, dsm_tile, file_path, extra_global_attributes,
+               valid_region):
+    """
+    Attach metadata to a 2D water layer, and write it to file.
+
+    :param xarray.DataArray water: Output of the WOFS algorithm
+    :param xarray.DataArray time: Time coordinate (of length one) of the acquisition
+
+    :return: Dataset object representing the generated data that can be added to the index
+    :rtype: datacube.model.Dataset
+    """
+    product = config['wofs_dataset_type']
+    app_info = get_app_metadata(config)
+
+    dtype = output.measurement_dtype(product)  # the flags fit in a byte, but older products store int16
+    result = water if water.dtype == dtype else water.astype(dtype)
 
     # Convert 2D DataArray to 3D DataSet
-    result = xarray.concat([result], dim=source.time).to_dataset(name='water')
+    result = xarray.concat([result], dim=time).to_dataset(name='water')
 
     # add metadata
     result.water.attrs['nodata'] = 1  # lest it default to zero (i.e. clear dry)
     result.water.attrs['units'] = '1'  # unitless (convention)
-    result.water.attrs['crs'] = source.crs
+    result.water.attrs['crs'] = crs
 
     # Attach CRS. Note this is poorly represented in NetCDF-CF
     # (and unrecognised in xarray), likely improved by datacube-API model.
-    result.attrs['crs'] = source.crs
+    result.attrs['crs'] = crs
 
     # Provenance tracking
     parent_sources = [ds for tile in [source_tile, pq_tile, dsm_tile] for ds in tile.sources.values[0]]
@@ -303,10 +504,11 @@ def do_wofs_task(config, source_tile, pq_tile, dsm_tile, file_path, tile_index,
     global_attributes.update(extra_global_attributes)
 
     # write output
-    datacube.storage.storage.write_dataset_to_netcdf(result, file_path,
-                                                     global_attributes=global_attributes,
-                                                     variable_params=config['variable_params'])
-    return [new_record]
+    with profiling.stage('write'):
+        datacube.storage.storage.write_dataset_to_netcdf(result, file_path,
+                                                         global_attributes=global_attributes,
+                                                         variable_params=output.variable_params(config))
+    return new_record
 
 
 def validate_year(ctx, param, value):
@@ -330,17 +532,30 @@ APP_NAME = 'wofs'
 @click.option('--dry-run', is_flag=True, default=False, help='Check if output files already exist')
 @click.option('--year', callback=validate_year, help='Limit the process to a particular year or a range of years')
 @click.option('--queue-size', type=click.IntRange(1, 100000), default=3200,
-              help='Number of tasks to queue at the start')
+              help='Maximum number of tasks in flight (fewer are queued if that keeps the workers busy)')
+@click.option('--queue-memory', type=click.IntRange(1), default=1024,
+              help='Approximate limit (in MB) on the size of the tasks in flight, held by the scheduler')
 @click.option('--print-output-product', is_flag=True)
 @click.option('--skip-indexing', is_flag=True, default=False)
+@click.option('--index-batch-size', type=click.IntRange(1, 10000), default=50,
+              help='Number of datasets to add to the index together, in one transaction (in the background). '
+                   'No effect where the datacube index lacks transactions (e.g. datacube 1.5)')
+@click.option('--cell-affinity', is_flag=True, default=False,
+              help='Run all tasks of a cell on the same worker (with the distributed executor), to reuse its DSM. '
+                   'Beyond %d workers, on the same group of workers' % scheduling.OPEN_CELLS)
+@click.option('--manifest', type=click.Path(dir_okay=False),
+              help='Record tasks and their status in this file, and resume any unfinished tasks it records')
+@click.option('--profile-output', type=click.Path(dir_okay=False),
+              help='Record the time and memory of each stage of each task, as lines of JSON in this file')
 #@click.option('--x', nargs=2, type=int) This functionality doesn't work, creates borders on tiles
 #@click.option('--y', nargs=2, type=int)
 @task_app_options
 @task_app(make_config=make_wofs_config, make_tasks=make_wofs_tasks)
-def wofs_app(index, config, tasks, executor, dry_run, queue_size,
-             print_output_product, skip_indexing, *args, **kwargs):
+def wofs_app(index, config, tasks, executor, dry_run, queue_size, queue_memory,
+             print_output_product, skip_indexing, index_batch_size, cell_affinity, manifest, profile_output,
+             *args, **kwargs):
     if dry_run:
-        check_existing_files((task['file_path'] for task in tasks))
+        check_existing_files((file_path for task in tasks for file_path in task_file_paths(task)))
         return 0
     else:
         if not skip_indexing:
@@ -353,47 +568,150 @@ def wofs_app(index, config, tasks, executor, dry_run, queue_size,
 
     click.echo('Starting processing...')
     results = []
+    in_flight = {}  # key, workers (if restricted) and submission time of each task, by id of its future
+    client = distributed_client(executor)
+    workers = client.scheduler_info()['workers'] if client else {}
+    if cell_affinity and not client:
+        _LOG.warning('Cell affinity needs the distributed executor, ignoring')
+    affinity = scheduling.CellAffinity(workers) if cell_affinity and client else None
+    if affinity:
+        tasks = scheduling.CellQueue(tasks, affinity)
+    window = scheduling.AdaptiveWindow(workers=scheduling.worker_threads(workers) or 1, maximum=queue_size,
+                                       memory_budget_mb=queue_memory)
+
+    def follow_workers():
+        """Size the window (and spread the cells) for the workers now connected, e.g. as more start up"""
+        workers = client.scheduler_info()['workers']
+        window.workers = max(1, scheduling.worker_threads(workers))
+        if affinity:
+            affinity.update(workers)
+    manifest = TaskManifest(manifest, query=None) if manifest else None
+    # tasks that a previous run may have written (but not indexed), before it was interrupted
+    interrupted = manifest.keys(RUNNING, INDEXING) if manifest else set()
+    profile_file = open(profile_output, 'a') if profile_output else None
+    profile_totals = {}
+    index_writer = None if skip_indexing else indexing.IndexWriter(index, batch_size=index_batch_size,
+                                                                   queue_size=10 * index_batch_size,
+                                                                   records=[] if profile_file else None)
 
     def submit_task(task):
-        _LOG.info('Queuing task: %s', task['tile_index'])
-        results.append(executor.submit(do_wofs_task, config=config, **task))
+        group = None
+        if 'tile_indexes' in task:
+            _LOG.info('Queuing stacked task: %s', task['tile_indexes'])
+            func, name = do_wofs_stack_task, task['tile_indexes']
+        else:
+            _LOG.info('Queuing task: %s', task['tile_index'])
+            func, name = do_wofs_task, task['tile_index']
+        restrictions = {}
+        if affinity:
+            group = affinity.submitted(scheduling.task_cell(task))
+        if group:
+            restrictions = dict(workers=list(group), allow_other_workers=True)  # others only if the group is lost
+        if profile_file:
+            future = executor.submit(profiling.run_profiled, name, func, config=config, **dict(task, **restrictions))
+        else:
+            future = executor.submit(func, config=config, **dict(task, **restrictions))
+        results.append(future)
+        in_flight[id(future)] = (task_key(task), group, time.time())
+        if manifest:
+            manifest.set_status(task_key(task), RUNNING)
+
+    existing = []  # keys of interrupted tasks not resubmitted, as their outputs exist
+
+    def fill_window():
+        """Submit tasks until the window is full, or there are no more"""
+        while len(results) < window.size:
+            start = time.time()
+            task = next(tasks, None)
+            if task is None:
+                return
+            key = task_key(task)
+            paths = [str(path) for path in task_file_paths(task) if path.exists()] if key in interrupted else []
+            if paths:
+                _LOG.error('Not reprocessing, as the output already exists (and may need indexing, e.g. with '
+                           '"datacube dataset add", or else removing): %s', ', '.join(paths))
+                existing.append(key)
+                manifest.set_status(key, INDEXING)  # so reported again, if resumed again
+                continue
+            submit_task(task)
+            window.record_submission(task, time.time() - start)
 
-    task_queue = itertools.islice(tasks, queue_size)
-    for task in task_queue:
-        submit_task(task)
+    fill_window()
     click.echo('Queue filled, waiting for first result...')
 
+    def record_indexed():
+        if manifest and index_writer:
+            for key in index_writer.pop_indexed():
+                manifest.set_status(key, DONE)
+
     successful = failed = 0
+    last_report = time.time()
     while results:
         result, results = executor.next_completed(results, None)
-
-        # submit a new task to replace the one we just finished
-        task = next(tasks, None)
-        if task:
-            submit_task(task)
+        key, group, submitted = in_flight.pop(id(result))
+        window.record_completion(time.time() - submitted)
+        if affinity:
+            affinity.completed(group)
+
+        # submit new tasks to replace the one we just finished
+        fill_window()
+        if time.time() - last_report > 60:
+            if client:
+                follow_workers()
+            _LOG.info('In flight: %d tasks (%s)', len(results), window.describe())
+            last_report = time.time()
 
         # Process the result
         try:
-            datasets = executor.result(result)
+            if profile_file:
+                datasets, profile = executor.result(result)
+            else:
+                datasets = executor.result(result)
             for dataset in datasets:
-                if not skip_indexing:
-                    start = time.clock()
-                    index.datasets.add(dataset, sources_policy='skip')
-                    indexing_time = time.clock() - start
-                    _LOG.info('Dataset added to index in %fs: id=%s path=%s', indexing_time, dataset.id, dataset.local_path)
-                else:
-                    _LOG.info('Dataset completed: id=%s path=%s', dataset.id, dataset.local_path)
+                _LOG.info('Dataset completed: id=%s path=%s', dataset.id, dataset.local_path)
+            if profile_file:
+                profile_file.write(profiling.dumps(profile) + '\n')
+                profiling.accumulate(profile_totals, profile['stages'])
             successful += 1
+            if manifest:
+                # done once its datasets are indexed (lest a killed job leave them unindexed, yet done)
+                manifest.set_status(key, INDEXING if index_writer and datasets else DONE)
+            if index_writer:
+                index_writer.add_all(datasets, task=key)  # waits while the writer is backlogged
+                record_indexed()
         except Exception as err:  # pylint: disable=broad-except
             _LOG.exception('Task failed: %s', err)
             failed += 1
+            if manifest:
+                manifest.set_status(key, FAILED)
             continue
         finally:
             # Release the task to free memory so there is no leak in executor/scheduler/worker process
             executor.release(result)
 
+    if index_writer:
+        index_writer.close()  # flush
+        record_indexed()
+        # tasks that failed to index count as failures
+        successful -= len(index_writer.failed)
+        failed += len(index_writer.failed)
+        for key in index_writer.failed:
+            if manifest:
+                manifest.set_status(key, FAILED)
+
+    failed += len(existing)
     click.echo('%d successful, %d failed' % (successful, failed))
+    click.echo('Final %s' % window.describe())
     _LOG.info('Completed: %d successful, %d failed', successful, failed)
+    if manifest:
+        _LOG.info('Manifest: %s', manifest.counts())
+    if affinity:
+        report_affinity(client, affinity)
+    if profile_file:
+        profile_file.close()
+        if index_writer:
+            profiling.accumulate(profile_totals, index_writer.records)
+        click.echo(profiling.format_totals(profile_totals))
 
 
 if __name__ == '__main__':